@@ -0,0 +1,151 @@
+"""Recall and latency of reduced/quantized video embeddings against the 3072-d float baseline.
+
+Queries are the catalog videos themselves (leave-one-out) plus, optionally, problem texts
+embedded with text-embedding-3-large. Run from the repository root:
+
+    python benchmarks/embedding_recall.py --index vector_index
+    python benchmarks/embedding_recall.py --from-db --queries problems.txt --db-latency
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from embedding_quantization import FULL_DIMENSIONS, quantize_binary, quantize_int8, reduce_dimensions  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+
+
+def load_catalog(args):
+    if args.index:
+        return VectorIndex.load(args.index, mmap=False)
+    from database import DatabaseManager
+    db_manager = DatabaseManager(os.getenv("SQLITECLOUD_API_KEY"), os.getenv("DB_NAME", "matematicas-top"))
+    try:
+        return VectorIndex.from_rows(db_manager.get_video_catalog())
+    finally:
+        db_manager.close()
+
+
+def embed_queries(path):
+    from utils import get_embeddings
+    with open(path, encoding="utf-8") as queries_file:
+        texts = [line.strip() for line in queries_file if line.strip()]
+    return np.asarray(get_embeddings(texts), dtype=np.float32)
+
+
+def coarse_scores(quantization, matrix, stored, query):
+    # Higher is closer for every scheme.
+    if quantization == "float":
+        return matrix @ query
+    if quantization == "int8":
+        diff = stored.astype(np.int32) - quantize_int8(query).astype(np.int32)
+        return -np.einsum("ij,ij->i", diff, diff)
+    return -POPCOUNT[np.bitwise_xor(stored, quantize_binary(query))].sum(axis=1)
+
+
+def top_k(scores, k, exclude=None):
+    if exclude is not None:
+        scores = scores.astype(np.float64)
+        scores[exclude] = -np.inf
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def run(matrix, queries, exclude, dimensions, quantization, k, oversample):
+    reduced = reduce_dimensions(matrix, dimensions)
+    stored = {"float": None, "int8": quantize_int8(reduced), "binary": quantize_binary(reduced)}[quantization]
+    reduced_queries = reduce_dimensions(queries, dimensions)
+    baseline = [top_k(matrix @ q, k, skip) for q, skip in zip(queries, exclude)]
+
+    hits, latencies = 0, []
+    for query, skip, expected in zip(reduced_queries, exclude, baseline):
+        start = time.perf_counter()
+        shortlist = top_k(coarse_scores(quantization, reduced, stored, query), k * oversample, skip)
+        if quantization != "float":
+            shortlist = shortlist[top_k(reduced[shortlist] @ query, k)]
+        found = shortlist[:k]
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(found.tolist()) & set(expected.tolist()))
+
+    bytes_per_vector = {"float": dimensions * 4, "int8": dimensions, "binary": dimensions // 8}[quantization]
+    return {
+        "recall": hits / (k * len(queries)),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "bytes_per_vector": bytes_per_vector,
+    }
+
+
+def db_latency(queries, dimensions, quantization, k, repeats):
+    from database import DatabaseManager
+    db_manager = DatabaseManager(
+        os.getenv("SQLITECLOUD_API_KEY"), os.getenv("DB_NAME", "matematicas-top"),
+        embedding_dimensions=dimensions, embedding_quantization=quantization,
+    )
+    try:
+        latencies = []
+        for query in queries[:repeats]:
+            start = time.perf_counter()
+            db_manager.retrieve_similar_vectors(reduce_dimensions(query, dimensions).tolist(), limit=k)
+            latencies.append(time.perf_counter() - start)
+        return float(np.percentile(latencies, 50) * 1000), float(np.percentile(latencies, 95) * 1000)
+    finally:
+        db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", help="saved VectorIndex path (built with full 3072-d vectors)")
+    parser.add_argument("--from-db", action="store_true", help="read the catalog embeddings from the database")
+    parser.add_argument("--queries", help="text file with one math problem per line to embed as extra queries")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[256, 512, 1024, 1536, FULL_DIMENSIONS])
+    parser.add_argument("--quantizations", nargs="+", default=["float", "int8", "binary"])
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--db-latency", action="store_true", help="also time retrieve_similar_vectors per table")
+    parser.add_argument("--db-repeats", type=int, default=20)
+    args = parser.parse_args()
+    load_dotenv()
+    if not args.index and not args.from_db:
+        parser.error("pass --index or --from-db")
+
+    index = load_catalog(args)
+    matrix = np.asarray(index.matrix, dtype=np.float32)
+    if matrix.shape[1] != FULL_DIMENSIONS:
+        parser.error(f"the baseline needs {FULL_DIMENSIONS}-d vectors, got {matrix.shape[1]}")
+
+    queries, exclude = matrix, list(range(len(matrix)))
+    if args.queries:
+        extra = reduce_dimensions(embed_queries(args.queries), FULL_DIMENSIONS)
+        queries = np.vstack([queries, extra])
+        exclude += [None] * len(extra)
+
+    print(f"{len(matrix)} videos, {len(queries)} queries, recall@{args.k} against exact {FULL_DIMENSIONS}-d float search")
+    header = f"{'dims':>6} {'quant':>7} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'bytes/vec':>10}"
+    if args.db_latency:
+        header += f" {'db p50 ms':>10} {'db p95 ms':>10}"
+    print(header)
+    for dimensions in args.dimensions:
+        for quantization in args.quantizations:
+            result = run(matrix, queries, exclude, dimensions, quantization, args.k, args.oversample)
+            line = (f"{dimensions:>6} {quantization:>7} {result['recall']:>7.3f} {result['p50_ms']:>8.3f} "
+                    f"{result['p95_ms']:>8.3f} {result['bytes_per_vector']:>10}")
+            if args.db_latency:
+                try:
+                    p50, p95 = db_latency(queries, dimensions, quantization, args.k, args.db_repeats)
+                    line += f" {p50:>10.1f} {p95:>10.1f}"
+                except Exception as e:
+                    line += f"  db error: {e}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Local stand-ins for OpenAI and the Telegram Bot API, plus helpers for the local database, used by load_test.py."""
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from PIL import Image, ImageDraw
+
+
+def _sleep(mean, jitter):
+    if mean > 0:
+        time.sleep(max(0.0, random.gauss(mean, mean * jitter)))
+
+
+def _unit_vector(text, dimensions):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeOpenAI:
+    """Mimics the parts of the OpenAI client the bot uses, with configurable latency and usage.
+
+    Latencies are seconds per call (gpt-4o, gpt-4o-mini, embeddings) plus a per-token delay for streams.
+    """
+
+    def __init__(self, latency=None, token_delay=0.01, jitter=0.2, completion_tokens=250, prompt_tokens=400,
+                 video_urls=()):
+        self.latency = {"gpt-4o": 2.0, "gpt-4o-mini": 0.8, "embeddings": 0.15, **(latency or {})}
+        self.token_delay = token_delay
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.prompt_tokens = prompt_tokens
+        self.video_urls = list(video_urls)
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+        self.embeddings = SimpleNamespace(create=self._create_embedding)
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _answer(self, messages):
+        prompt = json.dumps(messages, ensure_ascii=False)
+        if "image_url" in prompt:
+            return f"x^2 - {random.randint(1, 10 ** 6)} = 0 - Ecuación de segundo grado"
+        if "Lista de videos" in prompt and self.video_urls:
+            return random.choice(self.video_urls)
+        words = ["Paso", "1:", "despejamos", "x", "y", "aplicamos", "la", "fórmula", "general", "\n"]
+        return " ".join(random.choice(words) for _ in range(self.completion_tokens))
+
+    def _usage(self):
+        return SimpleNamespace(prompt_tokens=self.prompt_tokens, completion_tokens=self.completion_tokens,
+                               total_tokens=self.prompt_tokens + self.completion_tokens)
+
+    def _create_completion(self, model, messages, stream=False, **kwargs):
+        self._count(model)
+        content = self._answer(messages)
+        if stream:
+            return self._stream(model, content)
+        _sleep(self.latency.get(model, 1.0), self.jitter)
+        message = SimpleNamespace(content=content, role="assistant")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=self._usage())
+
+    def _stream(self, model, content):
+        # Time to first token is a fraction of the call latency; the rest is paid per token.
+        _sleep(self.latency.get(model, 1.0) * 0.2, self.jitter)
+        for word in content.split(" "):
+            time.sleep(self.token_delay)
+            delta = SimpleNamespace(content=word + " ", role=None)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        yield SimpleNamespace(choices=[], usage=self._usage())
+
+    def _create_embedding(self, input, model, dimensions=3072, **kwargs):
+        self._count(model)
+        _sleep(self.latency["embeddings"], self.jitter)
+        texts = [input] if isinstance(input, str) else list(input)
+        data = [SimpleNamespace(embedding=_unit_vector(text, dimensions).tolist(), index=i)
+                for i, text in enumerate(texts)]
+        return SimpleNamespace(data=data, usage=SimpleNamespace(prompt_tokens=len(texts) * 20, total_tokens=len(texts) * 20))
+
+
+def sample_photo(seed, size=(1280, 960)):
+    # A white page with a few random strokes; different seeds give different perceptual hashes.
+    rng = random.Random(seed)
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0] - 200), rng.randrange(size[1] - 100)
+        draw.line([(x, y), (x + rng.randrange(50, 200), y + rng.randrange(-80, 80))], fill=0, width=6)
+        draw.text((x, y + 20), f"{rng.randrange(100)}x+{rng.randrange(100)}", fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class FakeTelegramServer:
+    """Just enough of the Bot API for the handlers: getMe, sendMessage, editMessageText, getFile and downloads."""
+
+    def __init__(self, latency=0.05, jitter=0.2, distinct_photos=50):
+        self.latency = latency
+        self.jitter = jitter
+        self.distinct_photos = distinct_photos
+        self.calls = {}
+        self.port = free_port()
+        self._message_ids = itertools.count(1)
+        self._photos = {}
+        self._server = None
+        self._thread = None
+        self.app = FastAPI()
+        self.app.post("/bot{token}/{method}")(self._method)
+        self.app.get("/file/bot{token}/{file_path:path}")(self._download)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def file_url(self):
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    async def _method(self, token, method, request: Request):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency > 0:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.latency * self.jitter)))
+        params = {key: values[0] for key, values in parse_qs((await request.body()).decode("utf-8")).items()}
+        return {"ok": True, "result": self._result(method, params)}
+
+    def _result(self, method, params):
+        now = int(time.time())
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "MathBench", "username": "mathbench_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            message_id = int(params["message_id"]) if "message_id" in params else next(self._message_ids)
+            return {"message_id": message_id, "date": now, "text": params.get("text", ""),
+                    "chat": {"id": chat_id, "type": "private"}}
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": 100000,
+                    "file_path": f"photos/{file_id}.jpg"}
+        return True
+
+    async def _download(self, token, file_path):
+        self.calls["download"] = self.calls.get("download", 0) + 1
+        seed = zlib.crc32(file_path.encode("utf-8")) % self.distinct_photos
+        if seed not in self._photos:
+            self._photos[seed] = sample_photo(seed)
+        return Response(self._photos[seed], media_type="image/jpeg")
+
+    def start(self):
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed_videos(db_manager, count, dimensions=3072):
+    # Synthetic catalog whose embeddings come from the same generator as FakeOpenAI.
+    with db_manager.transaction() as conn:
+        if conn.execute('SELECT COUNT(*) FROM yt_videos').fetchone()[0] >= count:
+            return [row[0] for row in conn.execute('SELECT url FROM yt_videos')]
+        conn.execute('DELETE FROM yt_videos')
+        conn.execute('DELETE FROM yt_videos_embeddings')
+        urls = []
+        for i in range(1, count + 1):
+            url = f"https://www.youtube.com/watch?v=bench{i:05d}"
+            description = f"Video {i}: ecuaciones de segundo grado, caso {i}"
+            conn.execute('INSERT INTO yt_videos (id, url, description) VALUES (?, ?, ?)', (i, url, description))
+            embedding = db_manager._embedding_value(_unit_vector(description, dimensions).tolist())
+            conn.execute('INSERT INTO yt_videos_embeddings (id, embedding) VALUES (?, ?)', (i, embedding))
+            urls.append(url)
+        conn.execute('UPDATE yt_catalog_version SET version = version + 1 WHERE id = 1')
+    return urls
+
+
+def seed_users(db_manager, user_ids):
+    # What /start does for a new user; without a balance row the handlers skip the work they are timing.
+    for user_id in user_ids:
+        if not db_manager.is_user_registered(user_id):
+            db_manager.create_user(user_id, None, f"Bench{user_id}", None)
+            db_manager.log_openai_usage(user_id, "INITIAL_TOKENS", -20000, 0)
+
+
+class DelayedBackend:
+    # Wraps a storage backend and delays every statement to approximate a remote database round trip.
+    def __init__(self, backend, latency):
+        self._backend = backend
+        self._latency = latency
+
+    def connect(self):
+        return _DelayedConnection(self._backend.connect(), self._latency)
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+
+class _DelayedConnection:
+    # Adds a fixed delay to every statement to approximate a remote database round trip.
+    def __init__(self, conn, latency):
+        self._conn = conn
+        self._latency = latency
+
+    def execute(self, *args):
+        time.sleep(self._latency)
+        return self._conn.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
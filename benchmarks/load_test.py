@@ -0,0 +1,320 @@
+"""Drive the webhook with synthetic Telegram updates against local fakes and report latency percentiles.
+
+Nothing leaves the machine: OpenAI is replaced by FakeOpenAI, the Bot API by FakeTelegramServer and
+SQLite Cloud by the local storage backend (a SQLite file, with sqlite-vec when it can be loaded). Run from the repository root:
+
+    python benchmarks/load_test.py --updates 200 --concurrency 20 --photo-ratio 0.5
+    python benchmarks/load_test.py --rate 10 --duration 30 --latency gpt-4o=3 --json before.json
+
+Environment variables understood by Config (STREAM_RESPONSES, RESPONSE_CACHE_BACKEND, ...) apply as usual.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+TOKEN = "123456:bench"
+USER_ID_BASE = 100000
+
+# Stages of the update the current queue worker is processing.
+_update_stages = contextvars.ContextVar("update_stages", default=None)
+
+
+def parse_latency(values):
+    latency = {}
+    for value in values:
+        name, _, seconds = value.partition("=")
+        latency[name] = float(seconds)
+    return latency
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"count": len(samples), "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(max(samples))}
+
+
+def prepare_environment(args, workdir):
+    # Config reads the environment when main is imported, so everything is set up front.
+    defaults = {
+        "OPENAI_API_KEY": "bench",
+        "TELEGRAM_BOT_API_KEY": TOKEN,
+        "SQLITECLOUD_API_KEY": "bench",
+        "ADMIN_CHAT_ID": "1",
+        "LOCAL_DB_PATH": os.path.join(workdir, "bench.sqlite"),
+        "USAGE_SPOOL_PATH": os.path.join(workdir, "usage_spool.jsonl"),
+        "RESPONSE_CACHE_PATH": os.path.join(workdir, "response_cache.sqlite"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite"),
+        "CONVERSATION_STORE_PATH": os.path.join(workdir, "conversations.sqlite"),
+        # Virtual users send far faster than people do; set these to measure admission control itself.
+        "ADMISSION_RATE": "1000",
+        "ADMISSION_BURST": "1000",
+        "MAX_PENDING_PER_USER": "1000",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ["TELEGRAM_BOT_API_KEY"] = TOKEN
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["USAGE_REPLICATION"] = "false"
+
+
+class LoadTest:
+    def __init__(self, args, main, telegram, openai_client):
+        self.args = args
+        self.main = main
+        self.telegram = telegram
+        self.openai_client = openai_client
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.pending = {}  # update_id -> (kind, sent_at, event)
+        self.end_to_end = {"text": [], "photo": []}
+        self.photos_not_downloaded = 0
+        self.acks = []
+        self.handlers = {}
+        self.stages = {}
+        self.errors = 0
+        self.rejected = 0
+
+    def record_trace(self, handler, seconds, stages):
+        self.handlers.setdefault(handler, []).append(seconds)
+        for stage, stage_seconds in stages.items():
+            self.stages.setdefault(stage, []).append(stage_seconds)
+        update_stages = _update_stages.get()
+        if update_stages is not None:
+            update_stages.update(stages)
+
+    def track_completion(self):
+        queue = self.main.bot.update_queue
+        process = queue._process
+
+        async def tracked(update):
+            # Handlers run in the worker's task, so the trace listener sees this update's stages.
+            stages = {}
+            _update_stages.set(stages)
+            try:
+                await process(update)
+            finally:
+                kind, sent_at, event = self.pending.pop(update.update_id)
+                if kind == "photo" and "telegram_download" not in stages:
+                    # Turned away before any work (no tokens left, say); not a photo latency sample.
+                    self.photos_not_downloaded += 1
+                else:
+                    self.end_to_end[kind].append(time.perf_counter() - sent_at)
+                event.set()
+
+        queue._process = tracked
+
+    def track_rejections(self):
+        bot = self.main.bot
+        enqueue = bot.enqueue_update
+
+        def tracked(update):
+            queued = enqueue(update)
+            if not queued and update.update_id in self.pending:
+                self.rejected += 1
+                self.pending.pop(update.update_id)[2].set()
+            return queued
+
+        bot.enqueue_update = tracked
+
+    def make_update(self, user_index):
+        update_id = next(self.update_ids)
+        user = {"id": USER_ID_BASE + user_index, "is_bot": False, "first_name": f"Bench{user_index}"}
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+        }
+        if random.random() < self.args.photo_ratio:
+            kind = "photo"
+            message["photo"] = [
+                {"file_id": f"photo-{update_id}-s", "file_unique_id": f"s{update_id}", "width": 320, "height": 240},
+                {"file_id": f"photo-{update_id}", "file_unique_id": f"m{update_id}", "width": 1280, "height": 960},
+            ]
+        else:
+            kind = "text"
+            message["text"] = f"¿Cómo resuelvo x^2 - {random.randint(1, 10 ** 6)} = 0?"
+        return kind, {"update_id": update_id, "message": message}
+
+    async def send(self, client, user_index):
+        kind, update = self.make_update(user_index)
+        event = asyncio.Event()
+        sent_at = time.perf_counter()
+        self.pending[update["update_id"]] = (kind, sent_at, event)
+        response = await client.post(self.main.config.WEBHOOK_PATH, json=update)
+        self.acks.append(time.perf_counter() - sent_at)
+        if response.status_code != 200:
+            self.errors += 1
+            self.pending.pop(update["update_id"], None)
+            event.set()
+        return event
+
+    async def closed_loop(self, client):
+        # Each virtual user waits for its reply before sending the next update.
+        sent = 0
+
+        async def user(index):
+            nonlocal sent
+            while sent < self.args.updates:
+                sent += 1
+                event = await self.send(client, index)
+                await event.wait()
+
+        await asyncio.gather(*(user(i) for i in range(self.args.concurrency)))
+
+    async def open_loop(self, client):
+        # Updates arrive at a fixed rate whether or not earlier ones finished.
+        events = []
+        interval = 1.0 / self.args.rate
+        deadline = time.perf_counter() + self.args.duration
+        index = 0
+        while time.perf_counter() < deadline:
+            events.append(await self.send(client, index % self.args.users))
+            index += 1
+            await asyncio.sleep(interval)
+        await asyncio.gather(*(event.wait() for event in events))
+
+    async def run(self):
+        import httpx
+        from metrics import metrics
+
+        metrics.add_trace_listener(self.record_trace)
+        app = self.main.app
+        async with self.main.lifespan(app):
+            self.track_completion()
+            self.track_rejections()
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                started = time.perf_counter()
+                if self.args.rate:
+                    await self.open_loop(client)
+                else:
+                    await self.closed_loop(client)
+                elapsed = time.perf_counter() - started
+            queue_stats = self.main.bot.update_queue.stats()
+            admission_stats = self.main.bot.admission.stats()
+        return self.report(elapsed, queue_stats, admission_stats)
+
+    def report(self, elapsed, queue_stats, admission_stats):
+        completed = sum(len(samples) for samples in self.end_to_end.values())
+        return {
+            "elapsed_seconds": elapsed,
+            "completed": completed,
+            "photos_not_downloaded": self.photos_not_downloaded,
+            "throughput_per_second": completed / elapsed if elapsed else 0.0,
+            "webhook_errors": self.errors,
+            "rejected": self.rejected,
+            "handler_failures": queue_stats["failed"],
+            "webhook_ack": percentiles(self.acks),
+            "end_to_end": {kind: percentiles(samples) for kind, samples in self.end_to_end.items() if samples},
+            "handlers": {name: percentiles(samples) for name, samples in sorted(self.handlers.items())},
+            "stages": {name: percentiles(samples) for name, samples in sorted(self.stages.items())},
+            "queue": {key: queue_stats[key] for key in ("max_depth", "wait_time_avg", "wait_time_max", "rejected")},
+            "admission": admission_stats,
+            "openai_calls": dict(self.openai_client.calls),
+            "openai_client": self.main.bot.openai_client.stats(),
+            "telegram_calls": dict(self.telegram.calls),
+        }
+
+
+def print_report(report):
+    print(f"\n{report['completed']} updates in {report['elapsed_seconds']:.1f}s "
+          f"({report['throughput_per_second']:.2f}/s), {report['webhook_errors']} webhook errors, "
+          f"{report['handler_failures']} handler failures, {report['rejected']} rejected, "
+          f"{report['photos_not_downloaded']} photos never downloaded")
+    header = f"{'':<34} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+
+    def section(title, rows):
+        print(f"\n{title}\n{header}")
+        for name, stats in rows.items():
+            print(f"{name:<34} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} "
+                  f"{stats['p99'] * 1000:>9.1f} {stats['max'] * 1000:>9.1f}")
+
+    section("Webhook", {"ack": report["webhook_ack"]})
+    section("End to end (webhook to handler done)", report["end_to_end"])
+    section("Handlers", report["handlers"])
+    section("Stages (total per request)", report["stages"])
+    print(f"\nQueue: {report['queue']}")
+    print(f"Admission: {report['admission']}")
+    print(f"OpenAI calls: {report['openai_calls']}")
+    print(f"OpenAI client: {report['openai_client']}")
+    print(f"Telegram calls: {report['telegram_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=100, help="total updates in closed-loop mode")
+    parser.add_argument("--concurrency", type=int, default=10, help="virtual users in closed-loop mode")
+    parser.add_argument("--rate", type=float, help="open-loop mode: updates per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="open-loop mode: seconds to send for")
+    parser.add_argument("--users", type=int, default=50, help="open-loop mode: distinct chats")
+    parser.add_argument("--photo-ratio", type=float, default=0.5)
+    parser.add_argument("--latency", nargs="*", default=[], metavar="MODEL=SECONDS",
+                        help="fake OpenAI latency, e.g. gpt-4o=2 gpt-4o-mini=0.8 embeddings=0.15")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds per streamed token")
+    parser.add_argument("--completion-tokens", type=int, default=250)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="added per SQL statement, e.g. 0.03 for a WAN")
+    parser.add_argument("--videos", type=int, default=200)
+    parser.add_argument("--distinct-photos", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="mathbot-bench-")
+    prepare_environment(args, workdir)
+
+    from fakes import DelayedBackend, FakeOpenAI, FakeTelegramServer, seed_users, seed_videos
+
+    telegram = FakeTelegramServer(latency=args.telegram_latency, distinct_photos=args.distinct_photos)
+    telegram.start()
+    os.environ["TELEGRAM_API_BASE_URL"] = telegram.base_url
+    os.environ["TELEGRAM_API_FILE_URL"] = telegram.file_url
+
+    from openai_client import set_openai_client
+    import main as bot_main
+
+    openai_client = FakeOpenAI(
+        latency=parse_latency(args.latency),
+        token_delay=args.token_delay,
+        completion_tokens=args.completion_tokens,
+    )
+    set_openai_client(openai_client)
+    bot = bot_main.get_bot()
+
+    db_manager = bot.db_manager
+    if args.db_latency:
+        db_manager.backend = DelayedBackend(db_manager.backend, args.db_latency)
+    db_manager.initialize_database()
+    if not db_manager.backend.supports_vec and not bot.video_index:
+        parser.error("sqlite-vec is not loadable here; run with VECTOR_INDEX_ENABLED=true")
+    openai_client.video_urls = seed_videos(db_manager, args.videos)
+    seed_users(db_manager, [USER_ID_BASE + index for index in range(max(args.concurrency, args.users))])
+
+    try:
+        report = asyncio.run(LoadTest(args, bot_main, telegram, openai_client).run())
+    finally:
+        telegram.stop()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
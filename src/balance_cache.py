@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class BalanceCache:
+    def __init__(self, ttl=30.0, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # user_id -> (expires_at, (tokens_used, total_cost) or None)
+        self._lock = threading.Lock()
+        # Every change bumps _generation; _changed remembers the last one per user so that a balance read
+        # before a change cannot be cached after it. Users dropped from _changed count as changed at _forgotten.
+        self._generation = 0
+        self._changed = OrderedDict()  # user_id -> generation of its last change
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_reads = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, user_id):
+        # Like get, but never counts as a hit or miss; for admission checks that must not touch the database.
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                return MISSING
+            return entry[1]
+
+    def generation(self):
+        # Taken before reading a balance from the database and handed back to set().
+        with self._lock:
+            return self._generation
+
+    def set(self, user_id, balance, generation=None):
+        with self._lock:
+            if generation is not None and self._changed.get(user_id, self._forgotten) > generation:
+                # Usage was logged while the balance was being read; the next miss reads it again.
+                self.stale_reads += 1
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, balance)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def apply_delta(self, user_id, tokens_used, estimated_cost):
+        # Only adjust balances we already hold; anything else is read fresh on the next miss.
+        with self._lock:
+            self._mark_changed(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            expires_at, balance = entry
+            tokens, cost = balance if balance is not None else (0, 0.0)
+            self._entries[user_id] = (expires_at, (tokens + tokens_used, cost + estimated_cost))
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._generation += 1
+                self._changed.clear()
+                self._forgotten = self._generation
+            else:
+                self._mark_changed(user_id)
+                self._entries.pop(user_id, None)
+
+    def _mark_changed(self, user_id):
+        self._generation += 1
+        self._changed[user_id] = self._generation
+        self._changed.move_to_end(user_id)
+        while len(self._changed) > self.maxsize:
+            self._forgotten = self._changed.popitem(last=False)[1]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "stale_reads": self.stale_reads}
@@ -11,6 +11,72 @@ class Config:
         self.WEBHOOK_URL = "https://matematicas-top-bot.onrender.com"
         self.WEBHOOK_PATH = f"/webhook/{self.TELEGRAM_BOT_TOKEN}"
         self.ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+        self.DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+        self.DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+        self.BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "30"))
+        self.USAGE_WRITE_BEHIND = os.getenv("USAGE_WRITE_BEHIND", "true").lower() == "true"
+        self.USAGE_SPOOL_PATH = os.getenv("USAGE_SPOOL_PATH", "usage_spool.jsonl")
+        self.USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "50"))
+        self.USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+        self.RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+        self.RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite")
+        self.RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+        self.IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "720"))
+        self.IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "1000000"))
+        self.IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+        self.IMAGE_AUTO_CROP = os.getenv("IMAGE_AUTO_CROP", "false").lower() == "true"
+        self.IMAGE_DEDUPE_ENABLED = os.getenv("IMAGE_DEDUPE_ENABLED", "true").lower() == "true"
+        self.IMAGE_DEDUPE_MAX_DISTANCE = int(os.getenv("IMAGE_DEDUPE_MAX_DISTANCE", "6"))
+        self.IMAGE_DEDUPE_MAX_ENTRIES = int(os.getenv("IMAGE_DEDUPE_MAX_ENTRIES", "2048"))
+        self.VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+        self.VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "")
+        self.VECTOR_INDEX_MMAP = os.getenv("VECTOR_INDEX_MMAP", "true").lower() == "true"
+        self.VECTOR_INDEX_REFRESH_INTERVAL = float(os.getenv("VECTOR_INDEX_REFRESH_INTERVAL", "300"))
+        self.EMBEDDING_CACHE_BACKEND = os.getenv("EMBEDDING_CACHE_BACKEND", "sqlite")
+        self.EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+        self.EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        self.EMBEDDING_CACHE_KEY_MODE = os.getenv("EMBEDDING_CACHE_KEY_MODE", "text")
+        self.RECOMMEND_MARGIN_THRESHOLD = float(os.getenv("RECOMMEND_MARGIN_THRESHOLD", "0.05"))
+        self.EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "3072"))
+        self.EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "float")
+        self.EMBEDDING_RERANK_OVERSAMPLE = int(os.getenv("EMBEDDING_RERANK_OVERSAMPLE", "4"))
+        self.WORKER_THREADS = int(os.getenv("WORKER_THREADS", "16"))
+        self.UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "200"))
+        self.UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+        self.STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+        self.STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+        self.STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "40"))
+        self.TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+        self.TELEGRAM_API_FILE_URL = os.getenv("TELEGRAM_API_FILE_URL", "https://api.telegram.org/file/bot")
+        self.STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cloud")
+        self.SQLITECLOUD_HOST = os.getenv("SQLITECLOUD_HOST", "ctemvrrusk.sqlite.cloud:8860")
+        self.LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "mathbot.sqlite")
+        self.USAGE_REPLICATION = os.getenv("USAGE_REPLICATION", "false").lower() == "true"
+        self.REPLICATION_SPOOL_PATH = os.getenv("REPLICATION_SPOOL_PATH", "replication_spool.jsonl")
+        self.CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "sqlite")
+        self.CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH", "conversations.sqlite")
+        self.CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+        self.CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", str(30 * 24 * 3600)))
+        self.ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "0.2"))
+        self.ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "6"))
+        self.ADMISSION_IMAGE_COST = float(os.getenv("ADMISSION_IMAGE_COST", "2"))
+        self.MAX_PENDING_PER_USER = int(os.getenv("MAX_PENDING_PER_USER", "3"))
+        self.PER_USER_CONCURRENCY = int(os.getenv("PER_USER_CONCURRENCY", "1"))
+        self.MAX_INFLIGHT_GPT4O = int(os.getenv("MAX_INFLIGHT_GPT4O", "6"))
+        self.MAX_INFLIGHT_GPT4O_MINI = int(os.getenv("MAX_INFLIGHT_GPT4O_MINI", "12"))
+        self.IMAGE_TOKEN_ESTIMATE = int(os.getenv("IMAGE_TOKEN_ESTIMATE", "3000"))
+        self.CHAT_TOKEN_ESTIMATE = int(os.getenv("CHAT_TOKEN_ESTIMATE", "800"))
+        self.OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+        self.OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+        self.OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+        self.OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+        self.OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+        self.OPENAI_HEDGE_QUANTILE = float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95"))
+        self.OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "1"))
+        self.OPENAI_MODEL_FALLBACKS = os.getenv("OPENAI_MODEL_FALLBACKS", "gpt-4o:gpt-4o-mini")
+        self.OPENAI_FALLBACK_LATENCY = float(os.getenv("OPENAI_FALLBACK_LATENCY", "45"))
+        self.OPENAI_PRICING = os.getenv("OPENAI_PRICING", "")
 
     def set_config(self):         
         os.environ["OPENAI_API_KEY"] = self.OPENAI_API_KEY
@@ -0,0 +1,149 @@
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=5, timeout=10.0, health_check_interval=30.0):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.logger = logging.getLogger(__name__)
+        self._idle = deque()  # (conn, last_used)
+        self._open = 0
+        self._closed = False
+        self._pending_reconnects = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "reconnects": 0,
+            "health_check_failures": 0,
+            "discarded": 0,
+        }
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except BaseException:
+            # The connection may be broken or mid-transaction; don't hand it out again.
+            self._discard(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def _checkout(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                self._cond.wait(remaining)
+            waited = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+        try:
+            if conn is None:
+                return self._new_connection()
+            if time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+                self._close_quietly(conn)
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                    self._pending_reconnects += 1
+                return self._new_connection()
+            return conn
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["connections_created"] += 1
+            if self._pending_reconnects:
+                self._pending_reconnects -= 1
+                self._stats["reconnects"] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except Exception as e:
+            self.logger.warning(f"Pooled connection failed health check: {e}")
+            return False
+
+    def _checkin(self, conn):
+        with self._cond:
+            if self._closed:
+                self._open -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._stats["discarded"] += 1
+            self._pending_reconnects += 1
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
@@ -0,0 +1,201 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+def encode_history(history):
+    payload = json.dumps(history, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(payload, 6)
+
+
+def decode_history(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class _LRU:
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryConversationStore:
+    # Single-process only: history is lost on restart, like the old context.user_data.
+    def __init__(self, max_messages=5, cache_size=10000):
+        self.max_messages = max_messages
+        self._histories = _LRU(cache_size)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            history = self._histories.get(user_id)
+            return list(history) if history is not None else None
+
+    def append(self, user_id, *messages):
+        with self._lock:
+            history = (self._histories.get(user_id) or []) + list(messages)
+            self._histories.put(user_id, history[-self.max_messages:])
+
+    def reset(self, user_id):
+        with self._lock:
+            self._histories.put(user_id, [])
+
+    def stats(self):
+        with self._lock:
+            return {"cached": len(self._histories)}
+
+
+class SQLiteConversationStore:
+    # Shared by every worker process on the host. Each row carries a revision so the in-memory
+    # copy is reused until another process changes it; checking costs one indexed read.
+    def __init__(self, path, max_messages=5, cache_size=10000, ttl=30 * 24 * 3600):
+        self.path = path
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._cache = _LRU(cache_size)  # user_id -> (revision, history)
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self._stats = {"hits": 0, "loads": 0, "writes": 0, "expired": 0}
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    user_id INTEGER PRIMARY KEY,
+                    revision INTEGER NOT NULL,
+                    history BLOB NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)')
+            # Running totals kept by triggers, as for the SQLite caches, so stats() reads one row.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversations_totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    entries INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS conversations_totals_insert AFTER INSERT ON conversations BEGIN
+                    UPDATE conversations_totals SET entries = entries + 1, bytes = bytes + LENGTH(NEW.history);
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS conversations_totals_update AFTER UPDATE OF history ON conversations BEGIN
+                    UPDATE conversations_totals SET bytes = bytes + LENGTH(NEW.history) - LENGTH(OLD.history);
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS conversations_totals_delete AFTER DELETE ON conversations BEGIN
+                    UPDATE conversations_totals SET entries = entries - 1, bytes = bytes - LENGTH(OLD.history);
+                END
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO conversations_totals (id, entries, bytes)
+                SELECT 0, COUNT(*), COALESCE(SUM(LENGTH(history)), 0) FROM conversations
+            ''')
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        conn = self._connection()
+        row = conn.execute('SELECT revision FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        with self._cache_lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] == row[0]:
+                self._stats["hits"] += 1
+                return list(cached[1])
+        row = conn.execute('SELECT revision, history FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        history = decode_history(row[1])
+        self._remember(user_id, row[0], history)
+        with self._cache_lock:
+            self._stats["loads"] += 1
+        return list(history)
+
+    def append(self, user_id, *messages):
+        # Read-modify-write under a write lock so concurrent workers never drop each other's messages.
+        self._write(user_id, lambda history: history + list(messages))
+
+    def reset(self, user_id):
+        self._write(user_id, lambda history: [])
+
+    def _write(self, user_id, update):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute('SELECT revision, history FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+            revision = row[0] + 1 if row else 1
+            current = decode_history(row[1]) if row else []
+            history = update(current)[-self.max_messages:]
+            conn.execute('''
+                INSERT INTO conversations (user_id, revision, history, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    revision = excluded.revision, history = excluded.history, updated_at = excluded.updated_at
+            ''', (user_id, revision, encode_history(history), now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._remember(user_id, revision, history)
+        with self._cache_lock:
+            self._stats["writes"] += 1
+            self._writes += 1
+            prune = self._writes % 1000 == 0
+        if prune:
+            self._stats["expired"] += conn.execute(
+                'DELETE FROM conversations WHERE updated_at < ?', (now - self.ttl,)
+            ).rowcount
+
+    def _remember(self, user_id, revision, history):
+        with self._cache_lock:
+            self._cache.put(user_id, (revision, history))
+
+    def stats(self):
+        entries, size = self._connection().execute('SELECT entries, bytes FROM conversations_totals').fetchone()
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._cache)
+        stats["entries"] = entries
+        stats["bytes"] = size
+        return stats
+
+
+def create_conversation_store(backend, path, max_messages=5, cache_size=10000, ttl=30 * 24 * 3600):
+    if backend == "memory":
+        return MemoryConversationStore(max_messages, cache_size)
+    if backend == "sqlite":
+        return SQLiteConversationStore(path, max_messages, cache_size, ttl)
+    raise ValueError(f"Unknown conversation store backend: {backend}")
@@ -1,94 +1,288 @@
 import contextlib
 from datetime import datetime
-import os
-import sqlitecloud
-from dotenv import load_dotenv
-from openai import OpenAI
-from utils import get_embedding
-import pandas as pd
-
-
- # TODO: add config here
-# Load environment variables from .env file
-load_dotenv()
-SQLITECLOUD_API_KEY = os.getenv("SQLITECLOUD_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-client = OpenAI()
+import json
+import logging
+import time
+import uuid
+from utils import get_embeddings
+from connection_pool import ConnectionPool
+from balance_cache import BalanceCache, MISSING
+from usage_buffer import UsageBuffer
+from metrics import metrics
+from storage import SQLiteCloudBackend, create_storage_backend
+from embedding_quantization import FULL_DIMENSIONS, decode_embedding, embeddings_table, reduce_dimensions
+import sys
+import numpy as np
+
+DEFAULT_CLOUD_HOST = "ctemvrrusk.sqlite.cloud:8860"
+# Bump when initialize_database creates something new so existing databases pick it up.
+SCHEMA_VERSION = 2
+
 
 class DatabaseManager:
-    def __init__(self, api_key, db_name):
+    def __init__(self, api_key, db_name, pool_size=5, pool_timeout=10.0, balance_cache_ttl=30.0,
+                 embedding_dimensions=FULL_DIMENSIONS, embedding_quantization="float", rerank_oversample=4,
+                 backend=None, host=DEFAULT_CLOUD_HOST):
         self.api_key = api_key
         self.db_name = db_name
+        self.backend = backend or SQLiteCloudBackend(api_key, db_name, host)
+        self.embedding_dimensions = embedding_dimensions
+        self.embedding_quantization = embedding_quantization
+        self.rerank_oversample = rerank_oversample
+        self.pool = ConnectionPool(self._connect, size=pool_size, timeout=pool_timeout)
+        self.balance_cache = BalanceCache(ttl=balance_cache_ttl)
+        self.usage_buffer = None
+        self.replication = None
+
+    def _connect(self):
+        return self.backend.connect()
 
     @contextlib.contextmanager
     def get_connection(self):
-        conn = sqlitecloud.connect(f"sqlitecloud://ctemvrrusk.sqlite.cloud:8860?apikey={self.api_key}")
-        conn.execute(f"USE DATABASE {self.db_name}")
-        try:
+        with self.pool.connection() as conn:
             yield conn
-        finally:
-            conn.close()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.get_connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def start_usage_writer(self, spool_path=None, batch_size=50, flush_interval=2.0):
+        # Buffer usage rows in memory and write them to the ledger in batches from a background thread.
+        self.usage_buffer = UsageBuffer(self._write_usage_rows, spool_path=spool_path,
+                                        batch_size=batch_size, flush_interval=flush_interval)
+        self.usage_buffer.start()
+
+    def usage_buffer_stats(self):
+        return self.usage_buffer.stats() if self.usage_buffer else None
+
+    def start_replication(self, replica, spool_path=None, batch_size=200, flush_interval=5.0):
+        # Copy every committed usage row to another database (the cloud one) in the background.
+        # Reads stay on this database; the replica only receives the ledger and its balances.
+        self.replication = UsageBuffer(replica._write_usage_rows, spool_path=spool_path,
+                                       batch_size=batch_size, flush_interval=flush_interval)
+        self.replication.start()
+
+    def replication_stats(self):
+        return self.replication.stats() if self.replication else None
+
+    def close(self):
+        if self.usage_buffer:
+            self.usage_buffer.stop()
+            self.usage_buffer = None
+        if self.replication:
+            self.replication.stop()
+            self.replication = None
+        self.pool.close()
+
+    @metrics.timed("db.initialize_database")
     def initialize_database(self):
-        self._create_users_table()
-        self._create_openai_usage_table()
-        self._create_yt_videos_table()
-        self._create_yt_videos_embeddings_table()
+        # One round trip when the schema is already current; otherwise every table in one transaction.
+        with self.get_connection() as conn:
+            reduced_table = self._reduced_table()
+            created = not self._schema_is_current(conn, reduced_table)
+        if created:
+            with self.transaction() as conn:
+                self._create_users_table(conn)
+                self._create_openai_usage_table(conn)
+                self._create_yt_videos_table(conn)
+                self._create_yt_videos_embeddings_table(conn)
+                if reduced_table != "yt_videos_embeddings":
+                    self._create_reduced_embeddings_table(conn, self.embedding_dimensions, self.embedding_quantization)
+                self._create_user_balances_table(conn)
+                self.migrate_user_balances(conn)
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL
+                    )
+                ''')
+                conn.execute('INSERT OR REPLACE INTO schema_version (id, version) VALUES (1, ?)', (SCHEMA_VERSION,))
+            self.balance_cache.invalidate()
+        with self.get_connection() as conn:
+            backfill = self._needs_backfill(conn, reduced_table)
+        if backfill:
+            count = self.migrate_embeddings(self.embedding_dimensions, self.embedding_quantization)
+            logging.getLogger(__name__).info(f"Filled {reduced_table} with {count} reduced embeddings")
+        return created
 
+    def _reduced_table(self):
+        # Without sqlite-vec there is no reduced table; the in-process index truncates the full vectors itself.
+        if not self.backend.supports_vec:
+            return "yt_videos_embeddings"
+        return embeddings_table(self.embedding_dimensions, self.embedding_quantization)
+
+    def _needs_backfill(self, conn, reduced_table):
+        # A reduced table that was just created (or left empty) would make vector search return nothing.
+        if reduced_table == "yt_videos_embeddings":
+            return False
+        return (conn.execute(f'SELECT 1 FROM {reduced_table} LIMIT 1').fetchone() is None
+                and conn.execute('SELECT 1 FROM yt_videos_embeddings LIMIT 1').fetchone() is not None)
+
+    def _schema_is_current(self, conn, reduced_table):
+        names = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE name IN ('schema_version', ?)", (reduced_table,)
+        ).fetchall()}
+        if "schema_version" not in names or reduced_table not in names | {"yt_videos_embeddings"}:
+            return False
+        row = conn.execute('SELECT version FROM schema_version WHERE id = 1').fetchone()
+        return row is not None and row[0] >= SCHEMA_VERSION
+
+    @metrics.timed("db.is_user_registered")
     def is_user_registered(self, user_id):
         with self.get_connection() as conn:
             cursor = conn.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
             return cursor.fetchone() is not None
 
-    def _create_users_table(self):
-        with self.get_connection() as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT
-                )
-            ''')
-            conn.commit()
+    def _create_users_table(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT
+            )
+        ''')
 
-    def _create_openai_usage_table(self):
-        with self.get_connection() as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS openai_usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    timestamp DATETIME,
-                    model TEXT,
-                    tokens_used INTEGER,
-                    estimated_cost REAL,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
-            conn.commit()
+    def _create_openai_usage_table(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS openai_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                timestamp DATETIME,
+                model TEXT,
+                tokens_used INTEGER,
+                estimated_cost REAL,
+                row_id TEXT,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        # row_id makes spool replays idempotent; ledgers created before it keep NULL there.
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(openai_usage)').fetchall()}
+        if "row_id" not in columns:
+            conn.execute('ALTER TABLE openai_usage ADD COLUMN row_id TEXT')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_openai_usage_row_id ON openai_usage (row_id)')
 
-    def _create_yt_videos_table(self):
-        with self.get_connection() as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS yt_videos (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    url TEXT NOT NULL,
-                    description TEXT NOT NULL
-                )
-            ''')
-            conn.commit()
+    def _create_user_balances_table(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_balances (
+                user_id INTEGER PRIMARY KEY,
+                tokens_used INTEGER NOT NULL DEFAULT 0,
+                total_cost REAL NOT NULL DEFAULT 0,
+                updated_at DATETIME,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_openai_usage_user_id ON openai_usage (user_id)')
 
-    def _create_yt_videos_embeddings_table(self):
-        with self.get_connection() as conn:
-            conn.execute('''
-                CREATE VIRTUAL TABLE IF NOT EXISTS yt_videos_embeddings USING vec0(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    embedding FLOAT[3072]
-                )
-            ''')
-            conn.commit()
+    def migrate_user_balances(self, conn):
+        # Databases created before user_balances existed only have the ledger; backfill once.
+        has_balances = conn.execute('SELECT 1 FROM user_balances LIMIT 1').fetchone() is not None
+        has_usage = conn.execute('SELECT 1 FROM openai_usage LIMIT 1').fetchone() is not None
+        if has_usage and not has_balances:
+            self._reconcile_balances(conn)
+
+    def reconcile_balances(self):
+        with self.transaction() as conn:
+            has_balances = conn.execute('SELECT 1 FROM user_balances LIMIT 1').fetchone() is not None
+            has_usage = conn.execute('SELECT 1 FROM openai_usage LIMIT 1').fetchone() is not None
+            if has_balances and not has_usage:
+                # e.g. a local copy pulled without the ledger: rebuilding would wipe every balance.
+                raise RuntimeError("openai_usage is empty; refusing to rebuild user_balances from it")
+            self._reconcile_balances(conn)
+        self.balance_cache.invalidate()
+
+    def _reconcile_balances(self, conn):
+        conn.execute('DELETE FROM user_balances')
+        conn.execute('''
+            INSERT INTO user_balances (user_id, tokens_used, total_cost, updated_at)
+            SELECT user_id, SUM(tokens_used), SUM(estimated_cost), ?
+            FROM openai_usage
+            GROUP BY user_id
+        ''', (str(datetime.now()),))
+
+    def _create_yt_videos_table(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS yt_videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                description TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_yt_videos_url ON yt_videos (url)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS yt_catalog_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO yt_catalog_version (id, version) VALUES (1, 0)')
+
+    def _create_yt_videos_embeddings_table(self, conn):
+        if not self.backend.supports_vec:
+            conn.execute('CREATE TABLE IF NOT EXISTS yt_videos_embeddings (id INTEGER PRIMARY KEY, embedding BLOB)')
+            return
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS yt_videos_embeddings USING vec0(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                embedding FLOAT[3072]
+            )
+        ''')
+
+    def _create_reduced_embeddings_table(self, conn, dimensions, quantization):
+        # Quantized tables keep a float copy of the reduced vector for the exact rerank step.
+        table = embeddings_table(dimensions, quantization)
+        if not self.backend.supports_vec:
+            raise RuntimeError(f"{table} needs sqlite-vec, which the {self.backend.name} database does not have")
+        column = {"float": "FLOAT", "int8": "INT8", "binary": "BIT"}[quantization]
+        full_column = f",\n                embedding_full FLOAT[{dimensions}]" if quantization != "float" else ""
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING vec0(
+                id INTEGER PRIMARY KEY,
+                embedding {column}[{dimensions}]{full_column}
+            )
+        ''')
 
+    def _insert_reduced_embeddings(self, conn, rows, dimensions, quantization):
+        table = embeddings_table(dimensions, quantization)
+        reduced = reduce_dimensions([embedding for _, embedding in rows], dimensions)
+        if quantization == "float":
+            values, row_placeholder = [], "(?, ?)"
+            for (video_id, _), vector in zip(rows, reduced):
+                values += [video_id, json.dumps(vector.tolist())]
+            columns = "id, embedding"
+        else:
+            quantize = "vec_quantize_int8(?, 'unit')" if quantization == "int8" else "vec_quantize_binary(?)"
+            values, row_placeholder = [], f"(?, {quantize}, ?)"
+            for (video_id, _), vector in zip(rows, reduced):
+                vector_json = json.dumps(vector.tolist())
+                values += [video_id, vector_json, vector_json]
+            columns = "id, embedding, embedding_full"
+        placeholders = ", ".join([row_placeholder] * len(rows))
+        conn.execute(f"INSERT INTO {table} ({columns}) VALUES {placeholders}", values)
+
+    def migrate_embeddings(self, dimensions, quantization, batch_size=100):
+        # Derive reduced/quantized vectors from the stored 3072-d ones; no embeddings API calls needed.
+        table = embeddings_table(dimensions, quantization)
+        rows = [(video_id, embedding) for video_id, _, _, embedding in self.get_video_catalog()]
+        with self.transaction() as conn:
+            self._create_reduced_embeddings_table(conn, dimensions, quantization)
+            conn.execute(f"DELETE FROM {table}")
+            for i in range(0, len(rows), batch_size):
+                batch = [(video_id, decode_embedding(embedding)) for video_id, embedding in rows[i:i + batch_size]]
+                self._insert_reduced_embeddings(conn, batch, dimensions, quantization)
+        return len(rows)
+
+    @metrics.timed("db.create_user")
     def create_user(self, user_id, username, first_name, last_name):
         with self.get_connection() as conn:
             conn.execute('''
@@ -98,42 +292,261 @@ class DatabaseManager:
             conn.commit()
 
     def log_openai_usage(self, user_id, model, tokens_used, estimated_cost):
-        with self.get_connection() as conn:
-            conn.execute('''
-                INSERT INTO openai_usage (user_id, timestamp, model, tokens_used, estimated_cost)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, datetime.now(), model, tokens_used, estimated_cost))
-            conn.commit()
+        row = (user_id, str(datetime.now()), model, tokens_used, estimated_cost, uuid.uuid4().hex)
+        if self.usage_buffer:
+            self.usage_buffer.append(row)
+        else:
+            self._write_usage_rows([row])
+        self.balance_cache.apply_delta(user_id, tokens_used, estimated_cost)
+
+    @metrics.timed("db.write_usage_rows")
+    def _write_usage_rows(self, rows, chunk_size=100):
+        # Rows are (user_id, timestamp, model, tokens_used, estimated_cost, row_id). A row whose row_id is
+        # already in the ledger was committed before a crash or by another process and is skipped, balance included.
+        with self.transaction() as conn:
+            rows = self._unrecorded_rows(conn, rows, chunk_size)
+            balances = {}
+            for user_id, timestamp, _, tokens_used, estimated_cost, _ in rows:
+                tokens, cost, _ = balances.get(user_id, (0, 0.0, None))
+                balances[user_id] = (tokens + tokens_used, cost + estimated_cost, timestamp)
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                placeholders = ", ".join(["(?, ?, ?, ?, ?, ?)"] * len(chunk))
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO openai_usage (user_id, timestamp, model, tokens_used, estimated_cost, row_id)
+                    VALUES {placeholders}
+                ''', [value for row in chunk for value in row])
+            for user_id, (tokens_used, estimated_cost, timestamp) in balances.items():
+                conn.execute('''
+                    INSERT INTO user_balances (user_id, tokens_used, total_cost, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        tokens_used = tokens_used + excluded.tokens_used,
+                        total_cost = total_cost + excluded.total_cost,
+                        updated_at = excluded.updated_at
+                ''', (user_id, tokens_used, estimated_cost, timestamp))
+        if self.replication:
+            for row in rows:
+                self.replication.append(row)
+
+    @staticmethod
+    def _unrecorded_rows(conn, rows, chunk_size):
+        # Spools written before row_id existed hold five-field rows; those get no id and cannot be deduplicated.
+        rows = [tuple(row) + (None,) * (6 - len(row)) for row in rows]
+        row_ids = [row[5] for row in rows if row[5]]
+        recorded = set()
+        for i in range(0, len(row_ids), chunk_size):
+            chunk = row_ids[i:i + chunk_size]
+            recorded.update(r[0] for r in conn.execute(
+                f'SELECT row_id FROM openai_usage WHERE row_id IN ({", ".join("?" * len(chunk))})', chunk
+            ).fetchall())
+        unrecorded = []
+        for row in rows:
+            if row[5] and row[5] in recorded:
+                continue
+            recorded.add(row[5])
+            unrecorded.append(row)
+        return unrecorded
+
+    def copy_from(self, source, tables=("users", "openai_usage", "user_balances", "yt_videos", "yt_catalog_version",
+                                        "yt_videos_embeddings"), batch_size=500):
+        # Seed this database from another one, e.g. a new local file from the cloud database.
+        # The ledger comes along so that reconcile can rebuild the copied balances.
+        copied = {}
+        for table in tables:
+            with source.get_connection() as source_conn, self.transaction() as conn:
+                cursor = source_conn.execute(f"SELECT * FROM {table}")
+                columns = [column[0] for column in cursor.description]
+                placeholders = ", ".join("?" * len(columns))
+                conn.execute(f"DELETE FROM {table}")
+                copied[table] = 0
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+                    copied[table] += len(rows)
+        self.balance_cache.invalidate()
+        return copied
 
     def get_user_usage(self, user_id):
-        with self.get_connection() as conn:
-            cursor = conn.execute('''
-                SELECT SUM(tokens_used) as total_tokens, SUM(estimated_cost) as total_cost
-                FROM openai_usage
-                WHERE user_id = ?
-            ''', (user_id,))
-            return cursor.fetchone()
+        balance = self.balance_cache.get(user_id)
+        if balance is not MISSING:
+            return balance
+        generation = self.balance_cache.generation()
+        lock = self.usage_buffer.commit_lock if self.usage_buffer else contextlib.nullcontext()
+        with lock:
+            with metrics.timed("db.get_user_usage"), self.get_connection() as conn:
+                cursor = conn.execute('''
+                    SELECT tokens_used, total_cost
+                    FROM user_balances
+                    WHERE user_id = ?
+                ''', (user_id,))
+                row = cursor.fetchone()
+            # Rows still waiting in the write-behind buffer count against the balance too.
+            if self.usage_buffer:
+                pending_tokens, pending_cost = self.usage_buffer.pending_delta(user_id)
+                if row or pending_tokens or pending_cost:
+                    row = ((row[0] if row else 0) + pending_tokens, (row[1] if row else 0.0) + pending_cost)
+        balance = (row[0], row[1]) if row else None
+        self.balance_cache.set(user_id, balance, generation)
+        return balance
 
     
 
     def insert_yt_data_csv(self, csv_file):
+        return self.ingest_yt_catalog(csv_file)
+
+    def ingest_yt_catalog(self, csv_file, batch_size=64):
+        import pandas as pd  # only needed here; keeps the bot's startup from paying for it
+        logger = logging.getLogger(__name__)
         df = pd.read_csv(csv_file, names=['url', 'description'])
-        for _, row in df.iterrows():
-            self._insert_video_data(row['url'], row['description'])
-            embedding = get_embedding(row['description'])
-            self._insert_video_embedding(embedding)
+        catalog = dict(zip(df['url'].str.strip(), df['description'].str.strip()))
 
+        with self.get_connection() as conn:
+            existing = {url: (video_id, description)
+                        for video_id, url, description in conn.execute('SELECT id, url, description FROM yt_videos')}
+            embedded = {row[0] for row in conn.execute('SELECT id FROM yt_videos_embeddings')}
+        # New videos, videos whose title changed and videos left without an embedding (e.g. by an
+        # ingest that failed partway) need one; get_video_catalog joins on it and skips them otherwise.
+        missing = {url for url, (video_id, description) in existing.items()
+                   if video_id not in embedded and catalog.get(url) == description}
+        pending = [(url, description) for url, description in catalog.items()
+                   if url not in existing or existing[url][1] != description or url in missing]
+        report = {"rows": len(catalog), "new": 0, "updated": 0, "missing_embedding": len(missing),
+                  "unchanged": len(catalog) - len(pending), "seconds": 0.0}
+
+        start = time.monotonic()
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            embeddings = get_embeddings([description for _, description in batch])
+            new_rows = [(url, description) for url, description in batch if url not in existing]
+            changed_rows = [(existing[url][0], description) for url, description in batch if url in existing]
+
+            with self.transaction() as conn:
+                ids = {url: existing[url][0] for url, _ in batch if url in existing}
+                if new_rows:
+                    placeholders = ", ".join(["(?, ?)"] * len(new_rows))
+                    conn.execute(f"INSERT INTO yt_videos (url, description) VALUES {placeholders}",
+                                 [value for row in new_rows for value in row])
+                    url_placeholders = ", ".join("?" * len(new_rows))
+                    cursor = conn.execute(f"SELECT MAX(id), url FROM yt_videos WHERE url IN ({url_placeholders}) GROUP BY url",
+                                          [url for url, _ in new_rows])
+                    ids.update({url: video_id for video_id, url in cursor.fetchall()})
+                for video_id, description in changed_rows:
+                    conn.execute("UPDATE yt_videos SET description = ? WHERE id = ?", (description, video_id))
+                if changed_rows:
+                    id_placeholders = ", ".join("?" * len(changed_rows))
+                    conn.execute(f"DELETE FROM yt_videos_embeddings WHERE id IN ({id_placeholders})",
+                                 [video_id for video_id, _ in changed_rows])
+                # Embeddings are keyed by the yt_videos id explicitly rather than by matching AUTOINCREMENT order.
+                placeholders = ", ".join(["(?, ?)"] * len(batch))
+                conn.execute(f"INSERT INTO yt_videos_embeddings (id, embedding) VALUES {placeholders}",
+                             [value for (url, _), embedding in zip(batch, embeddings)
+                              for value in (ids[url], self._embedding_value(embedding))])
+                reduced_table = self._reduced_table()
+                if reduced_table != "yt_videos_embeddings":
+                    if changed_rows:
+                        conn.execute(f"DELETE FROM {reduced_table} WHERE id IN ({id_placeholders})",
+                                     [video_id for video_id, _ in changed_rows])
+                    self._insert_reduced_embeddings(
+                        conn, [(ids[url], embedding) for (url, _), embedding in zip(batch, embeddings)],
+                        self.embedding_dimensions, self.embedding_quantization,
+                    )
+                conn.execute("UPDATE yt_catalog_version SET version = version + 1 WHERE id = 1")
+
+            report["new"] += len(new_rows)
+            report["updated"] += sum(1 for url, _ in batch if url in existing and url not in missing)
+            done = min(i + batch_size, len(pending))
+            elapsed = time.monotonic() - start
+            logger.info(f"Ingested {done}/{len(pending)} videos ({done / elapsed:.1f} videos/s)")
+
+        report["seconds"] = time.monotonic() - start
+        report["videos_per_second"] = len(pending) / report["seconds"] if report["seconds"] else 0.0
+        logger.info(f"Catalog ingestion finished: {report}")
+        return report
+
+    def _embedding_value(self, embedding):
+        # vec0 parses JSON vectors; the plain fallback table stores float32 blobs like vec0 returns them.
+        if self.backend.supports_vec:
+            return json.dumps(embedding)
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    @metrics.timed("db.retrieve_similar_vectors")
     def retrieve_similar_vectors(self, sample_embedding, limit=4):
+        limit = int(limit)
+        if not self.backend.supports_vec:
+            raise RuntimeError(f"Vector search needs sqlite-vec; enable VECTOR_INDEX_ENABLED on the {self.backend.name} database")
+        table = embeddings_table(self.embedding_dimensions, self.embedding_quantization)
+        if table == "yt_videos_embeddings":
+            query = json.dumps([float(value) for value in sample_embedding])
+        else:
+            query = json.dumps(reduce_dimensions(sample_embedding, self.embedding_dimensions).tolist())
+
         with self.get_connection() as conn:
+            if self.embedding_quantization == "float":
+                cursor = conn.execute(f"""
+                    SELECT id, distance
+                    FROM {table}
+                    WHERE embedding MATCH ?
+                    ORDER BY distance
+                    LIMIT {limit}
+                """, (query,))
+                return cursor.fetchall()
+
+            # Coarse search on the quantized column, then rerank the shortlist at full precision.
+            quantize = "vec_quantize_int8(?, 'unit')" if self.embedding_quantization == "int8" else "vec_quantize_binary(?)"
             cursor = conn.execute(f"""
-                SELECT id, distance
-                FROM yt_videos_embeddings
-                WHERE embedding MATCH '{sample_embedding}'
+                WITH coarse AS (
+                    SELECT id
+                    FROM {table}
+                    WHERE embedding MATCH {quantize}
+                    ORDER BY distance
+                    LIMIT {limit * self.rerank_oversample}
+                )
+                SELECT t.id, vec_distance_l2(t.embedding_full, ?) AS distance
+                FROM {table} t
+                JOIN coarse ON coarse.id = t.id
                 ORDER BY distance
                 LIMIT {limit}
+            """, (query, query))
+            return cursor.fetchall()
+
+    @metrics.timed("db.get_videos_details")
+    def get_videos_details(self, video_ids):
+        if not video_ids:
+            return {}
+        placeholders = ", ".join("?" * len(video_ids))
+        with self.get_connection() as conn:
+            cursor = conn.execute(f"""
+                SELECT id, url, description
+                FROM yt_videos
+                WHERE id IN ({placeholders})
+            """, list(video_ids))
+            return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    @metrics.timed("db.get_video_catalog")
+    def get_video_catalog(self):
+        with self.get_connection() as conn:
+            cursor = conn.execute("""
+                SELECT v.id, v.url, v.description, e.embedding
+                FROM yt_videos v
+                JOIN yt_videos_embeddings e ON e.id = v.id
+                ORDER BY v.id
             """)
             return cursor.fetchall()
 
+    @metrics.timed("db.get_video_catalog_signature")
+    def get_video_catalog_signature(self):
+        with self.get_connection() as conn:
+            row = conn.execute("""
+                SELECT COUNT(*), COALESCE(MAX(id), 0),
+                       (SELECT COALESCE(MAX(version), 0) FROM yt_catalog_version)
+                FROM yt_videos
+            """).fetchone()
+            return (row[0], row[1], row[2])
+
+    @metrics.timed("db.get_video_details")
     def get_video_details(self, video_id):
         with self.get_connection() as conn:
             cursor = conn.execute("""
@@ -145,26 +558,29 @@ class DatabaseManager:
             return result if result else (None, None)
 
 
-    def _insert_video_embedding(self, embedding):
-        with self.get_connection() as conn:
-            embedding_str = ', '.join(map(str, embedding))
-            conn.execute(f"""
-                INSERT INTO yt_videos_embeddings (embedding)
-                VALUES ('[{embedding_str}]')
-            """)
-            conn.commit()
-
-    def _insert_video_data(self, url, description):
-        with self.get_connection() as conn:
-            conn.execute("""
-                INSERT INTO yt_videos (url, description)
-                VALUES (?, ?)
-            """, (url, description))
-            conn.commit()
-
 if __name__ == "__main__":
-    db_manager = DatabaseManager(os.getenv("SQLITECLOUD_API_KEY"), os.getenv("DB_NAME", "matematicas-top"))
+    from config import Config
+    config = Config()
+    backend = create_storage_backend(config.STORAGE_BACKEND, config.SQLITECLOUD_API_KEY, config.DB_NAME,
+                                     config.SQLITECLOUD_HOST, config.LOCAL_DB_PATH)
+    db_manager = DatabaseManager(config.SQLITECLOUD_API_KEY, config.DB_NAME, backend=backend)
     db_manager.initialize_database()
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        # Rebuild user_balances from the openai_usage ledger: python src/database.py reconcile
+        db_manager.reconcile_balances()
+    elif len(sys.argv) > 2 and sys.argv[1] == "ingest":
+        # Upsert the YouTube catalog: python src/database.py ingest data/yt/videos.csv
+        logging.basicConfig(level=logging.INFO)
+        db_manager.ingest_yt_catalog(sys.argv[2])
+    elif len(sys.argv) > 3 and sys.argv[1] == "migrate-embeddings":
+        # Build a reduced/quantized copy of the video embeddings: python src/database.py migrate-embeddings 512 int8
+        db_manager.migrate_embeddings(int(sys.argv[2]), sys.argv[3])
+    elif len(sys.argv) > 1 and sys.argv[1] == "pull":
+        # Seed the local database from SQLite Cloud: STORAGE_BACKEND=local python src/database.py pull
+        cloud = DatabaseManager(config.SQLITECLOUD_API_KEY, config.DB_NAME, host=config.SQLITECLOUD_HOST)
+        print(db_manager.copy_from(cloud))
+        cloud.close()
+    db_manager.close()
      # Assuming clear_database is a method to clear the database
 
 # Usage example:
@@ -0,0 +1,58 @@
+import unicodedata
+import numpy as np
+from response_cache import MemoryCacheBackend, SQLiteCacheBackend
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def problem_type(text):
+    # parse_image answers "<equation> - <problem type>"; the type alone is a coarser key.
+    _, separator, suffix = text.rpartition(" - ")
+    return suffix.strip() if separator and suffix.strip() else text
+
+
+class EmbeddingCache:
+    def __init__(self, backend, key_mode="text"):
+        if key_mode not in ("text", "problem_type"):
+            raise ValueError(f"Unknown embedding cache key mode: {key_mode}")
+        self.backend = backend
+        self.key_mode = key_mode
+        self.hits = 0
+        self.misses = 0
+
+    def key_text(self, text):
+        return problem_type(text) if self.key_mode == "problem_type" else text
+
+    def _key(self, model, text):
+        return f"{model}:{normalize_text(text)}"
+
+    def get(self, model, text):
+        value = self.backend.get(self._key(model, text))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    def set(self, model, text, embedding):
+        self.backend.set(self._key(model, text), np.asarray(embedding, dtype=np.float32).tobytes())
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        lookups = self.hits + self.misses
+        stats["hit_rate"] = self.hits / lookups if lookups else 0.0
+        return stats
+
+
+def create_embedding_cache(backend, path, max_bytes, key_mode="text", ttl=365 * 24 * 3600):
+    if backend == "memory":
+        return EmbeddingCache(MemoryCacheBackend(max_bytes, ttl), key_mode)
+    if backend == "sqlite":
+        return EmbeddingCache(SQLiteCacheBackend(path, max_bytes, ttl, table="embedding_cache"), key_mode)
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown embedding cache backend: {backend}")
@@ -0,0 +1,40 @@
+import json
+import numpy as np
+
+FULL_DIMENSIONS = 3072
+QUANTIZATIONS = ("float", "int8", "binary")
+
+
+def decode_embedding(embedding):
+    # vec0 returns float32 blobs; other drivers or vec_to_json() give JSON text.
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        return np.frombuffer(embedding, dtype=np.float32)
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def reduce_dimensions(vectors, dimensions):
+    # text-embedding-3 vectors are Matryoshka-trained: truncating and renormalizing matches the API's `dimensions`.
+    vectors = np.asarray(vectors, dtype=np.float32)[..., :dimensions]
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize_int8(vectors):
+    # Same mapping as sqlite-vec's vec_quantize_int8(v, 'unit'): [-1, 1] -> [-128, 127].
+    vectors = np.clip(np.asarray(vectors, dtype=np.float32), -1.0, 1.0)
+    return np.trunc((vectors + 1.0) / (2.0 / 255.0) - 128.0).astype(np.int8)
+
+
+def quantize_binary(vectors):
+    # Same as sqlite-vec's vec_quantize_binary: one bit per dimension, set when positive.
+    return np.packbits(np.asarray(vectors) > 0, axis=-1, bitorder="little")
+
+
+def embeddings_table(dimensions, quantization):
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown embedding quantization: {quantization}")
+    if dimensions == FULL_DIMENSIONS and quantization == "float":
+        return "yt_videos_embeddings"
+    return f"yt_videos_embeddings_{dimensions}_{quantization}"
@@ -0,0 +1,75 @@
+import io
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+
+def dhash(image_bytes, hash_size=16, ink_threshold=64):
+    image = ImageOps.autocontrast(Image.open(io.BytesIO(image_bytes)).convert("L"))
+    # Hash only the written area; a mostly blank page would otherwise make every photo look alike.
+    bbox = ImageOps.invert(image).point(lambda p: 255 if p > ink_threshold else 0).getbbox()
+    if bbox:
+        image = image.crop(bbox)
+    image = image.resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class PerceptualHashIndex:
+    def __init__(self, max_entries=2048, max_distance=6, hash_size=16):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self._entries = OrderedDict()  # hash -> {"math_problem", "parse", "solution"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hash(self, image_bytes):
+        return dhash(image_bytes, self.hash_size)
+
+    def lookup(self, image_hash):
+        with self._lock:
+            best, best_distance = None, self.max_distance + 1
+            for candidate in self._entries:
+                distance = (candidate ^ image_hash).bit_count()
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+                    if distance == 0:
+                        break
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return dict(self._entries[best])
+
+    def add(self, image_hash, math_problem, parse_usage):
+        with self._lock:
+            self._entries[image_hash] = {"math_problem": math_problem, "parse": parse_usage, "solution": None}
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_solution(self, image_hash, solution):
+        with self._lock:
+            if image_hash in self._entries:
+                self._entries[image_hash]["solution"] = solution
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
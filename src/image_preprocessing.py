@@ -0,0 +1,73 @@
+import io
+import math
+from PIL import Image, ImageChops, ImageOps
+
+
+def estimate_vision_tokens(width, height):
+    # OpenAI's high-detail accounting: fit in 2048x2048, shortest side to 768, then 170 tokens per 512px tile.
+    if max(width, height) > 2048:
+        scale = 2048 / max(width, height)
+        width, height = width * scale, height * scale
+    if min(width, height) > 768:
+        scale = 768 / min(width, height)
+        width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def select_photo_size(photo_sizes, min_side):
+    # Telegram lists the sizes of a photo from smallest to largest.
+    for photo in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        if min(photo.width, photo.height) >= min_side:
+            return photo
+    return photo_sizes[-1]
+
+
+class ImagePreprocessor:
+    def __init__(self, max_pixels=1_000_000, jpeg_quality=85, auto_crop=False, crop_threshold=40, crop_padding=16):
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.auto_crop = auto_crop
+        self.crop_threshold = crop_threshold
+        self.crop_padding = crop_padding
+
+    def process(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        original_size = image.size
+
+        if self.auto_crop:
+            image = self._crop_whitespace(image)
+
+        width, height = image.size
+        if width * height > self.max_pixels:
+            scale = math.sqrt(self.max_pixels / (width * height))
+            image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        processed = output.getvalue()
+        if image.size == original_size and len(processed) >= len(image_bytes):
+            processed = image_bytes
+
+        report = {
+            "original_bytes": len(image_bytes),
+            "processed_bytes": len(processed),
+            "original_size": original_size,
+            "processed_size": image.size,
+            "original_tokens": estimate_vision_tokens(*original_size),
+            "processed_tokens": estimate_vision_tokens(*image.size),
+        }
+        return processed, report
+
+    def _crop_whitespace(self, image):
+        gray = image.convert("L")
+        background = Image.new("L", gray.size, 255)
+        mask = ImageChops.difference(gray, background).point(lambda p: 255 if p > self.crop_threshold else 0)
+        bbox = mask.getbbox()
+        if not bbox:
+            return image
+        left, top, right, bottom = bbox
+        pad = self.crop_padding
+        return image.crop((max(0, left - pad), max(0, top - pad),
+                           min(image.width, right + pad), min(image.height, bottom + pad)))
@@ -1,39 +1,239 @@
+from time import perf_counter
+IMPORT_STARTED = perf_counter()
+
 import logging
-from telegram import Update, Bot
+from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 import os
 from config import Config
 from math_assistant import MathAssistant
 from database import DatabaseManager
-from openai import OpenAI
+from balance_cache import MISSING
+from storage import create_storage_backend
+from response_cache import create_response_cache
+from image_preprocessing import ImagePreprocessor, select_photo_size
+from image_dedupe import PerceptualHashIndex
+from vector_index import VideoVectorIndex
+from embedding_cache import create_embedding_cache
+from conversation_store import create_conversation_store
+from update_queue import UpdateQueue, QueueFull
+from scheduler import AdmissionController, Rejected
+from telegram_streaming import StreamingReply, iterate_in_executor
+from metrics import metrics
+from openai_client import get_openai_client, ResilientOpenAI, PricingTable, parse_fallbacks
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 import uvicorn
 import asyncio
-from time import time
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
-config = Config()
-config.set_config()
+IMPORTS_FINISHED = perf_counter()
 
-TELEGRAM_TOKEN = config.TELEGRAM_BOT_TOKEN
-WEBHOOK_URL = config.WEBHOOK_URL  # Add this to your Config class
+REJECTION_MESSAGES = {
+    "busy": "Ahora mismo estoy atendiendo a muchos estudiantes 🙏 Vuelve a enviarme tu mensaje en un momento.",
+    "too_many_pending": "Todavía estoy trabajando en tus mensajes anteriores ⏳ Espera a que termine y vuelve a enviarme este.",
+    "rate_limited": "¡Vas muy rápido! 😅 Espera un momento antes de enviarme otro problema.",
+    "no_tokens": "Lo siento, has agotado tus tokens. Invita a un amigo para obtener más tokens.",
+}
 
 class MathBot:
     def __init__(self, config: Config):
         self.config = config
         self.logger = logging.getLogger(__name__)
-        self.openai_client = OpenAI()
-        self.db_manager = DatabaseManager(self.config.SQLITECLOUD_API_KEY, self.config.DB_NAME)
-        self.math_assistant = MathAssistant(self.db_manager, self.openai_client)
-        self.application = ApplicationBuilder().token(self.config.TELEGRAM_BOT_TOKEN).build()
+        self.startup_timings = {}
+        self.openai_client = ResilientOpenAI(
+            get_openai_client(),
+            pricing=PricingTable.from_json(self.config.OPENAI_PRICING),
+            timeout=self.config.OPENAI_TIMEOUT,
+            max_retries=self.config.OPENAI_MAX_RETRIES,
+            backoff_base=self.config.OPENAI_BACKOFF_BASE,
+            backoff_max=self.config.OPENAI_BACKOFF_MAX,
+            hedge=self.config.OPENAI_HEDGE_ENABLED,
+            hedge_quantile=self.config.OPENAI_HEDGE_QUANTILE,
+            hedge_min_delay=self.config.OPENAI_HEDGE_MIN_DELAY,
+            fallbacks=parse_fallbacks(self.config.OPENAI_MODEL_FALLBACKS),
+            fallback_latency=self.config.OPENAI_FALLBACK_LATENCY,
+        )
+        self.db_manager = DatabaseManager(
+            self.config.SQLITECLOUD_API_KEY,
+            self.config.DB_NAME,
+            backend=create_storage_backend(
+                self.config.STORAGE_BACKEND,
+                api_key=self.config.SQLITECLOUD_API_KEY,
+                db_name=self.config.DB_NAME,
+                host=self.config.SQLITECLOUD_HOST,
+                path=self.config.LOCAL_DB_PATH,
+            ),
+            pool_size=self.config.DB_POOL_SIZE,
+            pool_timeout=self.config.DB_POOL_TIMEOUT,
+            balance_cache_ttl=self.config.BALANCE_CACHE_TTL,
+            embedding_dimensions=self.config.EMBEDDING_DIMENSIONS,
+            embedding_quantization=self.config.EMBEDDING_QUANTIZATION,
+            rerank_oversample=self.config.EMBEDDING_RERANK_OVERSAMPLE,
+        )
+        self.replica_db_manager = None
+        if self.config.STORAGE_BACKEND == "local" and self.config.USAGE_REPLICATION:
+            self.replica_db_manager = DatabaseManager(
+                self.config.SQLITECLOUD_API_KEY,
+                self.config.DB_NAME,
+                pool_size=1,
+                host=self.config.SQLITECLOUD_HOST,
+            )
+        self.response_cache = create_response_cache(
+            self.config.RESPONSE_CACHE_BACKEND,
+            self.config.RESPONSE_CACHE_PATH,
+            self.config.RESPONSE_CACHE_MAX_BYTES,
+            self.config.RESPONSE_CACHE_TTL,
+        )
+        self.image_preprocessor = ImagePreprocessor(
+            max_pixels=self.config.IMAGE_MAX_PIXELS,
+            jpeg_quality=self.config.IMAGE_JPEG_QUALITY,
+            auto_crop=self.config.IMAGE_AUTO_CROP,
+        )
+        self.image_index = None
+        if self.config.IMAGE_DEDUPE_ENABLED:
+            self.image_index = PerceptualHashIndex(
+                max_entries=self.config.IMAGE_DEDUPE_MAX_ENTRIES,
+                max_distance=self.config.IMAGE_DEDUPE_MAX_DISTANCE,
+            )
+        self.video_index = None
+        if self.config.VECTOR_INDEX_ENABLED:
+            self.video_index = VideoVectorIndex(
+                self.db_manager,
+                path=self.config.VECTOR_INDEX_PATH or None,
+                mmap=self.config.VECTOR_INDEX_MMAP,
+                refresh_interval=self.config.VECTOR_INDEX_REFRESH_INTERVAL,
+                dimensions=self.config.EMBEDDING_DIMENSIONS,
+            )
+        self.embedding_cache = create_embedding_cache(
+            self.config.EMBEDDING_CACHE_BACKEND,
+            self.config.EMBEDDING_CACHE_PATH,
+            self.config.EMBEDDING_CACHE_MAX_BYTES,
+            key_mode=self.config.EMBEDDING_CACHE_KEY_MODE,
+        )
+        self.conversations = create_conversation_store(
+            self.config.CONVERSATION_STORE,
+            self.config.CONVERSATION_STORE_PATH,
+            cache_size=self.config.CONVERSATION_CACHE_SIZE,
+            ttl=self.config.CONVERSATION_TTL,
+        )
+        self.math_assistant = MathAssistant(
+            self.db_manager, self.openai_client, self.response_cache, self.image_preprocessor,
+            self.image_index, self.video_index, self.embedding_cache,
+            rerank_margin=self.config.RECOMMEND_MARGIN_THRESHOLD,
+            embedding_dimensions=self.config.EMBEDDING_DIMENSIONS,
+        )
+        self.application = (
+            ApplicationBuilder()
+            .token(self.config.TELEGRAM_BOT_TOKEN)
+            .base_url(self.config.TELEGRAM_API_BASE_URL)
+            .base_file_url(self.config.TELEGRAM_API_FILE_URL)
+            .build()
+        )
         self.running = False
-        self.bot = Bot(token=self.config.TELEGRAM_BOT_TOKEN)
+        self.executor = ThreadPoolExecutor(max_workers=self.config.WORKER_THREADS, thread_name_prefix="mathbot-worker")
+        self.update_queue = UpdateQueue(
+            self.process_update,
+            maxsize=self.config.UPDATE_QUEUE_SIZE,
+            workers=self.config.UPDATE_WORKERS,
+        )
+        self.admission = AdmissionController(
+            self.cached_balance,
+            rate=self.config.ADMISSION_RATE,
+            burst=self.config.ADMISSION_BURST,
+            costs={"image": self.config.ADMISSION_IMAGE_COST, "text": 1},
+            token_estimates={"image": self.config.IMAGE_TOKEN_ESTIMATE, "text": self.config.CHAT_TOKEN_ESTIMATE},
+            max_pending_per_user=self.config.MAX_PENDING_PER_USER,
+            per_user_concurrency=self.config.PER_USER_CONCURRENCY,
+            lanes={"gpt-4o": self.config.MAX_INFLIGHT_GPT4O, "gpt-4o-mini": self.config.MAX_INFLIGHT_GPT4O_MINI},
+        )
+        self.admitted = {}  # update_id -> (user_id, kind) until the update has been handled
+        self.handler_errors = {}  # update_id -> exception raised by its handler
+        self.busy_replies = set()
+        self.register_metrics()
+
+    def register_metrics(self):
+        metrics.add_collector("db_pool", self.db_manager.pool_stats)
+        metrics.add_collector("balance_cache", self.db_manager.balance_cache.stats)
+        metrics.add_collector("usage_buffer", self.db_manager.usage_buffer_stats)
+        metrics.add_collector("replication", self.db_manager.replication_stats)
+        metrics.add_collector("update_queue", self.update_queue.stats)
+        metrics.add_collector("admission", self.admission.stats)
+        metrics.add_collector("openai", self.openai_client.stats)
+        metrics.add_collector("recommendations", lambda: dict(self.math_assistant.recommendation_stats))
+        metrics.add_collector("startup_seconds", lambda: self.startup_timings)
+        metrics.add_collector("conversations", self.conversations.stats)
+        if self.response_cache:
+            metrics.add_collector("response_cache", self.response_cache.stats)
+        if self.embedding_cache:
+            metrics.add_collector("embedding_cache", self.embedding_cache.stats)
+        if self.image_index:
+            metrics.add_collector("image_dedupe", self.image_index.stats)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        # OpenAI and database calls are synchronous; keep them off the event loop.
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def stream_reply(self, message, chunks):
+        # Sends the text as it is generated; returns the full reply for the history.
+        reply = StreamingReply(
+            message,
+            edit_interval=self.config.STREAM_EDIT_INTERVAL,
+            min_chars=self.config.STREAM_MIN_CHARS,
+        )
+        started = monotonic()
+        text = await reply.stream(iterate_in_executor(self.executor, chunks))
+        if reply.first_output_at is not None:
+            metrics.observe("first_output_seconds", reply.first_output_at - started)
+            self.logger.info(
+                f"Streamed reply: first output after {reply.first_output_at - started:.2f}s, "
+                f"{reply.messages} messages, {reply.edits} edits"
+            )
+        return text
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.openai_client.close()
+        self.db_manager.close()
+        if self.replica_db_manager:
+            self.replica_db_manager.close()
+
+    async def timed_step(self, name, step):
+        start = perf_counter()
+        result = await step
+        self.startup_timings[name] = perf_counter() - start
+        return result
+
+    async def prepare_storage(self):
+        created = await self.timed_step("schema", self.run_blocking(self.db_manager.initialize_database))
+        self.logger.info("Database schema created" if created else "Database schema is current")
+        if self.video_index:
+            await self.timed_step("vector_index", self.run_blocking(self.video_index.load))
 
     async def setup(self):
-        self.db_manager.initialize_database()
+        # The database bootstrap and the Bot API handshake don't depend on each other.
+        await asyncio.gather(
+            self.prepare_storage(),
+            self.timed_step("telegram_initialize", self.application.initialize()),
+        )
+        if self.config.USAGE_WRITE_BEHIND:
+            self.db_manager.start_usage_writer(
+                spool_path=self.config.USAGE_SPOOL_PATH,
+                batch_size=self.config.USAGE_BATCH_SIZE,
+                flush_interval=self.config.USAGE_FLUSH_INTERVAL,
+            )
+        if self.replica_db_manager:
+            await self.run_blocking(self.replica_db_manager.initialize_database)
+            self.db_manager.start_replication(self.replica_db_manager, spool_path=self.config.REPLICATION_SPOOL_PATH)
         self.setup_handlers()
-        await self.application.initialize()
-        await self.application.bot.set_webhook(url=self.config.get_webhook_url())
+        await self.update_queue.start()
+        await self.timed_step("set_webhook", self.application.bot.set_webhook(url=self.config.get_webhook_url()))
         self.logger.info(f"Webhook set to {self.config.get_webhook_url()}")
         self.running = True
 
@@ -43,56 +243,78 @@ class MathBot:
         self.application.add_handler(CommandHandler("referral", self.referral))
         self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_image))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        self.application.add_error_handler(self.handler_error)
+
+    async def handler_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        # PTB catches handler exceptions inside process_update; keep them so the update queue counts the failure.
+        self.logger.error(f"Handler error: {context.error}", exc_info=context.error)
+        if isinstance(update, Update):
+            self.handler_errors[update.update_id] = context.error
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        if not self.db_manager.is_user_registered(user.id):
-            self.db_manager.create_user(user.id, user.username, user.first_name, user.last_name)
-            self.db_manager.log_openai_usage(user.id, "INITIAL_TOKENS", -20000, 0)
+        if not await self.run_blocking(self.db_manager.is_user_registered, user.id):
+            await self.run_blocking(self.db_manager.create_user, user.id, user.username, user.first_name, user.last_name)
+            await self.run_blocking(self.db_manager.log_openai_usage, user.id, "INITIAL_TOKENS", -20000, 0)
             await update.message.reply_text(f"¡Bienvenido, {user.first_name}! Tienes 1,000,000 de tokens para empezar.")
 
         if context.args:
             referrer_id = int(context.args[0])
-            if referrer_id != user.id and self.db_manager.is_user_registered(referrer_id):
-                self.db_manager.log_openai_usage(referrer_id, "REFERRAL_BONUS", -10000, 0)
+            if referrer_id != user.id and await self.run_blocking(self.db_manager.is_user_registered, referrer_id):
+                await self.run_blocking(self.db_manager.log_openai_usage, referrer_id, "REFERRAL_BONUS", -10000, 0)
                 await update.message.reply_text(f"Te has registrado con un código de referencia. ¡Tu amigo ha ganado 1,000,000 de tokens extra!")
 
         self.logger.info(f"User {user.first_name} started the bot.")
         await update.message.reply_text(f"""
         ¡Hola, {user.first_name}! 👋 Soy Matemáticas TOP, aquí para ayudarte con todo lo de matemáticas. 📚✨ ¿Tienes dudas o problemas por resolver? Mándame tus preguntas o una foto del problema, ¡y te lo resuelvo! 📸 Y no olvides pasarte por mi canal de YouTube 🎥👉 https://www.youtube.com/@matematicastop para más trucos y ayuda. ¿Qué necesitas hoy? 😊""")
 
-        context.user_data['history'] = []
+        await self.run_blocking(self.conversations.reset, user.id)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metrics.trace("handle_message"):
+            await self._handle_message(update, context)
+
+    async def _handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        usage = self.db_manager.get_user_usage(user.id)
+        usage = await self.run_blocking(self.db_manager.get_user_usage, user.id)
         if usage:
             available_tokens = max(0, -usage[0])
             if available_tokens <= 0:
                 await update.message.reply_text("Lo siento, has agotado tus tokens. Invita a un amigo para obtener más tokens.")
                 return
         
-        if 'history' not in context.user_data:
+        history = await self.run_blocking(self.conversations.get, user.id)
+        if history is None:
             await self.start(update, context)
-        message = update.message.text
+            history = []
+        message = {"role": "user", "content": update.message.text}
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-        context.user_data['history'].append({"role": "user", "content": message})
 
-        response = self.math_assistant.chat(context.user_data['history'], user.id)
-        context.user_data['history'].append({"role": "assistant", "content": response})
-
-        if len(context.user_data['history']) > 5:
-            context.user_data['history'] = context.user_data['history'][-5:]
+        with metrics.timed("chat"):
+            async with self.admission.slot("gpt-4o-mini", user.id):
+                if self.config.STREAM_RESPONSES:
+                    chunks = self.math_assistant.chat_stream(history + [message], user.id)
+                    response = await self.stream_reply(update.message, chunks)
+                else:
+                    response = await self.run_blocking(self.math_assistant.chat, history + [message], user.id)
+        await self.run_blocking(
+            self.conversations.append, user.id, message, {"role": "assistant", "content": response}
+        )
 
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-        await update.message.reply_text(response)
+        if not self.config.STREAM_RESPONSES:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+            await update.message.reply_text(response)
 
     async def handle_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metrics.trace("handle_image"):
+            await self._handle_image(update, context)
+
+    async def _handle_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         self.logger.info("Received an image from the user.")
         user = update.effective_user
 
         # Check if user has enough tokens
-        usage = self.db_manager.get_user_usage(user.id)
+        usage = await self.run_blocking(self.db_manager.get_user_usage, user.id)
         if usage:
             available_tokens = max(0, -usage[0])  # usage[0] is negative for available tokens
             if available_tokens <= 0:
@@ -101,37 +323,43 @@ class MathBot:
 
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
             
-            file = await context.bot.get_file(update.message.photo[-1].file_id)
-            
-            image_path = 'temp_equation.jpg'
-            await file.download_to_drive(image_path)
-            self.logger.info(f"Image downloaded to {image_path}.")
-            
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-            math_problem = self.math_assistant.parse_image(image_path, user.id)
+            photo = select_photo_size(update.message.photo, self.config.IMAGE_MIN_SIDE)
+            with metrics.timed("telegram_download"):
+                file = await context.bot.get_file(photo.file_id)
+                image_bytes = await file.download_as_bytearray()
+            self.logger.info(f"Image downloaded ({len(image_bytes)} bytes).")
             
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-            solution = self.math_assistant.solve_math_problem(math_problem, user.id)
-            
+
+            async def deliver(future):
+                result = await asyncio.wrap_future(future)
+                await update.message.reply_text(result)
+                return result
+
+            # The slot covers both gpt-4o calls (parse, then solve), so at most MAX_INFLIGHT_GPT4O run at once.
+            async with self.admission.slot("gpt-4o", user.id):
+                math_problem, solution, video_future = await self.run_blocking(
+                    self.math_assistant.process_image, image_bytes, user.id, self.executor,
+                    stream_solution=self.config.STREAM_RESPONSES,
+                )
+                await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+                if self.config.STREAM_RESPONSES:
+                    solution_reply = self.stream_reply(update.message, solution)
+                else:
+                    solution_reply = deliver(solution)
+                solution, yt_video_link = await asyncio.gather(solution_reply, deliver(video_future))
             self.logger.info("Equation solved.")
-            
-            await update.message.reply_text(solution)
-            
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-            
-            yt_video_link = self.math_assistant.recommend_yt_video(math_problem, user.id)
-            await update.message.reply_text(yt_video_link)
-        
-            os.remove(image_path)
-            self.logger.info(f"Temporary image {image_path} deleted.")
 
-            context.user_data['history'].append({"role": "user", "content": "El usuario envió una imagen de un problema matemático."})
-            context.user_data['history'].append({"role": "assistant", "content": f"He resuelto el problema matemático: {solution}\n\nAquí hay un video relevante: {yt_video_link}"})
+            await self.run_blocking(
+                self.conversations.append, user.id,
+                {"role": "user", "content": "El usuario envió una imagen de un problema matemático."},
+                {"role": "assistant", "content": f"He resuelto el problema matemático: {solution}\n\nAquí hay un video relevante: {yt_video_link}"},
+            )
 
 
     async def show_usage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        usage = self.db_manager.get_user_usage(user.id)
+        usage = await self.run_blocking(self.db_manager.get_user_usage, user.id)
         if usage:
             available_tokens = max(0, -usage[0])
             await update.message.reply_text(f"Tienes {available_tokens} tokens 💰 disponibles para usar.")
@@ -142,11 +370,73 @@ class MathBot:
         user = update.effective_user
         referral_link = f"https://t.me/{context.bot.username}?start={user.id}"
         await update.message.reply_text(f'🌟 Tu enlace de referencia: {referral_link}. Invita a amigos 👥 y recibirás 10,000 de tokens extra para usar aquí 💰! ')
+
+    def cached_balance(self, user_id):
+        # Admission runs on the event loop, so it only looks at balances already in memory.
+        balance = self.db_manager.balance_cache.peek(user_id)
+        if balance is MISSING or balance is None:
+            return None
+        return max(0, -balance[0])
+
+    @staticmethod
+    def admission_kind(update: Update):
+        message = update.message
+        if message is None or update.effective_user is None:
+            return None
+        if message.photo:
+            return "image"
+        if message.text and not message.text.startswith("/"):
+            return "text"
+        return None
+
+    def enqueue_update(self, update: Update):
+        # Returns whether the update was queued.
+        if update.update_id in self.admitted:
+            # A retry of an update still in flight, possibly already gone from the queue's dedupe window.
+            return False
+        kind = self.admission_kind(update)
+        try:
+            return self.update_queue.submit(update, functools.partial(self.admit, update, kind) if kind else None)
+        except QueueFull:
+            self.logger.warning(f"Update queue full, rejecting update {update.update_id}")
+            if update.effective_chat:
+                self.send_busy_reply(update.effective_chat.id)
+        except Rejected as e:
+            self.send_busy_reply(update.effective_chat.id, REJECTION_MESSAGES[e.reason])
+        return False
+
+    def send_busy_reply(self, chat_id, text=None):
+        # The event loop only holds tasks weakly; keep a reference until the reply has been sent.
+        task = asyncio.create_task(self.reply_busy(chat_id, text))
+        self.busy_replies.add(task)
+        task.add_done_callback(self.busy_replies.discard)
+
+    def admit(self, update: Update, kind):
+        user_id = update.effective_user.id
+        self.admission.admit(user_id, kind)
+        self.admitted[update.update_id] = (user_id, kind)
+
+    async def process_update(self, update: Update):
+        try:
+            await self.application.process_update(update)
+            error = self.handler_errors.pop(update.update_id, None)
+            if error:
+                raise error
+        finally:
+            if update.update_id in self.admitted:
+                self.admission.done(*self.admitted.pop(update.update_id))
+
+    async def reply_busy(self, chat_id, text=None):
+        try:
+            await self.application.bot.send_message(chat_id=chat_id, text=text or REJECTION_MESSAGES["busy"])
+        except Exception as e:
+            self.logger.error(f"Error sending busy reply: {e}")
+
     async def keep_alive(self):
         while True:
             try:
                 if self.config.ADMIN_CHAT_ID:
-                    await self.bot.send_message(chat_id=self.config.ADMIN_CHAT_ID, text="/start")
+                    await self.application.bot.send_message(chat_id=self.config.ADMIN_CHAT_ID, text="/start")
                     self.logger.info("Sent keep-alive message")
                 else:
                     self.logger.warning("ADMIN_CHAT_ID not set, skipping keep-alive message")
@@ -155,15 +445,33 @@ class MathBot:
                 self.logger.error(f"Error in keep_alive: {e}")
                 await asyncio.sleep(60)
 config = Config()
-bot = MathBot(config)
+bot = None
+
+
+def get_bot():
+    # Built on first use rather than at import so importing main stays cheap and side-effect free.
+    global bot
+    if bot is None:
+        start = perf_counter()
+        config.set_config()
+        bot = MathBot(config)
+        bot.startup_timings["construct"] = perf_counter() - start
+    return bot
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    config.set_config()
+    bot = get_bot()
     await bot.setup()
+    bot.startup_timings["imports"] = IMPORTS_FINISHED - IMPORT_STARTED
+    bot.startup_timings["total"] = perf_counter() - IMPORT_STARTED
+    bot.logger.info("Startup: " + ", ".join(f"{step}={seconds * 1000:.0f}ms" for step, seconds in bot.startup_timings.items()))
     background_tasks = BackgroundTasks()
     background_tasks.add_task(bot.keep_alive)
     yield {"background_tasks": background_tasks}
+    await bot.update_queue.stop()
+    await asyncio.gather(*bot.busy_replies, return_exceptions=True)
+    bot.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -171,14 +479,25 @@ app = FastAPI(lifespan=lifespan)
 async def webhook_handler(request: Request):
     data = await request.json()
     update = Update.de_json(data, bot.application.bot)
-    await bot.application.process_update(update)
+    # Acknowledge right away; Telegram retries webhooks that stay open too long.
+    bot.enqueue_update(update)
     return {"ok": True}
 
 @app.get("/healthz")
 async def health_check():
-    if not bot.running:
+    if bot is None or not bot.running:
         raise HTTPException(status_code=503, detail="Bot is not running")
     return {"status": "healthy"}
 
+@app.get("/healthz/queue")
+async def queue_stats():
+    return bot.update_queue.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Cache collectors may touch SQLite, so render off the event loop.
+    body = await bot.run_blocking(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -1,15 +1,35 @@
 import base64
-import functools
-import json
+import io
+import logging
+from collections import Counter
+from concurrent.futures import Future
+from types import SimpleNamespace
 from dotenv import load_dotenv
+from metrics import metrics, submit_in_context
 
 
 class MathAssistant:
-    def __init__(self,db_manager,openai_client):
+    def __init__(self,db_manager,openai_client,response_cache=None,image_preprocessor=None,image_index=None,video_index=None,embedding_cache=None,rerank_margin=0.05,embedding_dimensions=3072):
         self.db_manager = db_manager
         self.openai_client = openai_client
+        self.response_cache = response_cache
+        self.image_preprocessor = image_preprocessor
+        self.image_index = image_index
+        self.video_index = video_index
+        self.embedding_cache = embedding_cache
+        self.rerank_margin = rerank_margin
+        self.embedding_dimensions = embedding_dimensions
+        self.recommendation_stats = Counter()
+        self.logger = logging.getLogger(__name__)
         
     def chat(self, messages: list[dict], user_id: int) -> str:
+        return self.query_openai(self._chat_messages(messages), "gpt-4o-mini", user_id)
+
+    def chat_stream(self, messages: list[dict], user_id: int):
+        return self.stream_openai(self._chat_messages(messages), "gpt-4o-mini", user_id)
+
+    @staticmethod
+    def _chat_messages(messages: list[dict]) -> list[dict]:
         system_message = {
             "role": "system",
             "content": """Eres Matemáticas TOP un asistente matemático amigable y conversacional. Este es tu canal youtube: https://www.youtube.com/@matematicastop. 
@@ -20,55 +40,131 @@ class MathAssistant:
             ."""
         }
         
-        full_messages = [system_message] + messages
-        
-        return self.query_openai(full_messages, "gpt-4o-mini", user_id)
+        return [system_message] + messages
 
     @staticmethod
-    def encode_image(image_path: str) -> str:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+    def read_image(image) -> bytes:
+        # Accepts raw bytes, an in-memory buffer or, for scripts, a path on disk.
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return image
+        if isinstance(image, io.BytesIO):
+            return image.getbuffer()
+        if hasattr(image, "read"):
+            return image.read()
+        with open(image, "rb") as image_file:
+            return image_file.read()
+
+    @classmethod
+    @metrics.timed("encode_image")
+    def encode_image(cls, image) -> str:
+        return base64.b64encode(cls.read_image(image)).decode("utf-8")
+
+    def preprocess_image(self, image_bytes: bytes) -> bytes:
+        if not self.image_preprocessor:
+            return image_bytes
+        with metrics.timed("preprocess_image"):
+            processed, report = self.image_preprocessor.process(image_bytes)
+        self.logger.info(
+            f"Image preprocessed: {report['original_bytes']} -> {report['processed_bytes']} bytes, "
+            f"{report['original_size']} -> {report['processed_size']} px, "
+            f"~{report['original_tokens']} -> ~{report['processed_tokens']} vision tokens"
+        )
+        return processed
+
+    def bill_cached(self, user_id: int, model: str, result: dict):
+        # Reused answers are still billed to the user as if the model had answered.
+        self.db_manager.log_openai_usage(user_id, model, result["total_tokens"], result["cost"])
+        metrics.inc("openai_requests_total", model=model, cached="true")
+
+    def complete(self, messages: list[dict], model: str, user_id: int) -> dict:
+        if self.response_cache:
+            cached = self.response_cache.get(model, messages)
+            if cached is not None:
+                self.bill_cached(user_id, model, cached)
+                return cached
+
+        answered_by, response = self.openai_client.complete(model, messages)
+        content = ""
+        if response.choices[0].message.content:
+            content = response.choices[0].message.content.strip()
+        return self._record_completion(messages, model, answered_by, user_id, content, response.usage)
+
+    def stream_openai(self, messages: list[dict], model: str, user_id: int):
+        # Yields text deltas as they arrive; the generator's return value is the same dict complete() returns.
+        if self.response_cache:
+            cached = self.response_cache.get(model, messages)
+            if cached is not None:
+                self.bill_cached(user_id, model, cached)
+                yield cached["content"]
+                return cached
+
+        answered_by, stream = self.openai_client.stream(model, messages, stream_options={"include_usage": True})
+        parts = []
+        usage = None
+        finished = False
+        try:
+            for chunk in stream:
+                # With include_usage the last chunk has no choices and carries the token counts.
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            finished = True
+        finally:
+            # Billed even when the stream fails or the reader stops early: the generated tokens cost the same.
+            content = "".join(parts).strip()
+            if usage is None:
+                usage = self.estimate_usage(messages, content)
+                self.logger.warning(
+                    f"{answered_by} stream ended without usage ({'complete' if finished else 'interrupted'}); "
+                    f"billing an estimated {usage.total_tokens} tokens"
+                )
+            result = self._record_completion(messages, model, answered_by, user_id, content, usage, cache=finished)
+        return result
 
     @staticmethod
-    def hashable_messages(messages):
-        return tuple(json.dumps(message, sort_keys=True) for message in messages)
-
-    @functools.lru_cache(maxsize=None)
-    def _cached_query_openai(self, hashed_messages: tuple, model: str, user_id: int) -> str:
-        messages = [json.loads(message) for message in hashed_messages]
-        response = self.openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
+    def estimate_usage(messages, content):
+        # About four characters per token; image parts are not counted, only text.
+        def characters(value):
+            if isinstance(value, str):
+                return len(value)
+            if isinstance(value, list):
+                return sum(len(part.get("text", "")) for part in value if isinstance(part, dict))
+            return 0
+        prompt_tokens = sum(characters(message.get("content")) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens
         )
-        usage = response.usage
-        
-        # TODO: move this to config file or somewhere
-        if model == "gpt-4o-mini":
-            input_cost = usage.prompt_tokens * 0.15 / 1000000
-            output_cost = usage.completion_tokens * 0.6 / 1000000
-        elif model == "gpt-4o":
-            input_cost = usage.prompt_tokens * 5 / 1000000
-            output_cost = usage.completion_tokens * 15 / 1000000
-        else:
-            input_cost = output_cost = 0
-        
-        total_cost = input_cost + output_cost
+
+    def _record_completion(self, messages, model, answered_by, user_id, content, usage, cache=True):
+        # Billed at the price of the model that answered; fallback answers are not cached under the requested model.
+        total_cost = self.openai_client.pricing.cost(answered_by, usage.prompt_tokens, usage.completion_tokens)
         total_tokens = usage.total_tokens
         
-        self.db_manager.log_openai_usage(user_id, model, total_tokens, total_cost)
-        
-        if response.choices[0].message.content:
-            return response.choices[0].message.content.strip()
-        return ""
+        self.db_manager.log_openai_usage(user_id, answered_by, total_tokens, total_cost)
+        metrics.inc("openai_requests_total", model=answered_by, cached="false")
+        metrics.inc("openai_tokens_total", usage.prompt_tokens, model=answered_by, kind="prompt")
+        metrics.inc("openai_tokens_total", usage.completion_tokens, model=answered_by, kind="completion")
+        metrics.inc("openai_cost_usd_total", total_cost, model=answered_by)
+
+        result = {"content": content, "total_tokens": total_tokens, "cost": total_cost}
+        if cache and self.response_cache and answered_by == model:
+            self.response_cache.set(model, messages, result)
+        return result
 
     def query_openai(self, messages: list[dict], model: str, user_id: int) -> str:
-        hashed_messages = self.hashable_messages(messages)
-        return self._cached_query_openai(hashed_messages, model, user_id)
+        return self.complete(messages, model, user_id)["content"]
+
+    @metrics.timed("parse_image")
+    def parse_image(self, image, user_id):
+        return self.query_openai(self._parse_image_messages(self.read_image(image)), "gpt-4o", user_id)
 
-    def parse_image(self, image_path, user_id):
-        base64_image = self.encode_image(image_path)
+    def _parse_image_messages(self, image_bytes):
+        base64_image = self.encode_image(self.preprocess_image(image_bytes))
         
-        messages = [
+        return [
             {
                 "role": "user",
                 "content": [
@@ -88,11 +184,17 @@ class MathAssistant:
                 ]
             }
         ]
-        
-        return self.query_openai(messages, "gpt-4o", user_id)
 
+    @metrics.timed("solve_math_problem")
     def solve_math_problem(self, math_problem: str, user_id: int):
-        messages = [
+        return self.query_openai(self._solve_messages(math_problem), "gpt-4o", user_id)
+
+    def solve_math_problem_stream(self, math_problem: str, user_id: int):
+        return self.stream_openai(self._solve_messages(math_problem), "gpt-4o", user_id)
+
+    @staticmethod
+    def _solve_messages(math_problem: str):
+        return [
             {
                 "role": "user",
                 "content": [
@@ -105,19 +207,52 @@ class MathAssistant:
                 ]
             }
         ]
-        
-        return self.query_openai(messages, "gpt-4o", user_id)
+
+    @metrics.timed("get_embedding")
     def get_embedding(self, text):
-        response = self.openai_client.embeddings.create(
-            input=text,
-            model="text-embedding-3-large"
-        )
-        return response.data[0].embedding
+        model = "text-embedding-3-large"
+        cache_model = f"{model}@{self.embedding_dimensions}"
+        if self.embedding_cache:
+            text = self.embedding_cache.key_text(text)
+            cached = self.embedding_cache.get(cache_model, text)
+            if cached is not None:
+                return cached
+        kwargs = {"dimensions": self.embedding_dimensions} if self.embedding_dimensions != 3072 else {}
+        response = self.openai_client.embed(model, text, **kwargs)
+        metrics.inc("openai_requests_total", model=model, cached="false")
+        metrics.inc("openai_tokens_total", response.usage.prompt_tokens, model=model, kind="prompt")
+        metrics.inc("openai_cost_usd_total", self.openai_client.pricing.cost(model, response.usage.prompt_tokens), model=model)
+        embedding = response.data[0].embedding
+        if self.embedding_cache:
+            self.embedding_cache.set(cache_model, text, embedding)
+        return embedding
+
+    def find_similar_videos(self, embedding, limit=5):
+        if self.video_index:
+            with metrics.timed("vector_index_search"):
+                return self.video_index.search(embedding, limit)
+        similar_vectors_in_yt_videos = self.db_manager.retrieve_similar_vectors(embedding, limit=limit)
+        details = self.db_manager.get_videos_details([id for id, _ in similar_vectors_in_yt_videos])
+        return [(id, distance, *details.get(id, ("", ""))) for id, distance in similar_vectors_in_yt_videos]
 
     def recommend_yt_video(self, math_problem: str, user_id: int):
         math_problem_embedding = self.get_embedding(math_problem)
-        similar_vectors_in_yt_videos = self.db_manager.retrieve_similar_vectors(math_problem_embedding, limit=5)
-        descriptions_and_links = "\n".join([":".join(self.db_manager.get_video_details(id) or ["", ""]) for id, _ in similar_vectors_in_yt_videos])
+        candidates = self.find_similar_videos(math_problem_embedding, limit=5)
+        # Only ask the LLM to choose when the nearest videos are too close to call.
+        if len(candidates) > 1:
+            margin = candidates[1][1] - candidates[0][1]
+        else:
+            margin = float("inf") if candidates else 0.0
+        path = "direct" if candidates and margin >= self.rerank_margin else "rerank"
+        self.recommendation_stats[path] += 1
+        self.logger.info(
+            f"Recommendation via {path} (margin {margin:.4f}, threshold {self.rerank_margin}); "
+            f"direct={self.recommendation_stats['direct']} rerank={self.recommendation_stats['rerank']}"
+        )
+        if path == "direct":
+            return candidates[0][2]
+
+        descriptions_and_links = "\n".join([f"{url}:{description}" for _, _, url, description in candidates])
         
         messages = [
             {
@@ -137,7 +272,52 @@ class MathAssistant:
             }
         ]
         
-        return self.query_openai(messages, "gpt-4o-mini", user_id)
+        with metrics.timed("rerank"):
+            return self.query_openai(messages, "gpt-4o-mini", user_id)
+
+    def process_image(self, image, user_id, executor, stream_solution=False):
+        image_bytes = self.read_image(image)
+        image_hash = self.image_index.hash(image_bytes) if self.image_index else None
+        entry = self.image_index.lookup(image_hash) if self.image_index else None
+
+        if entry:
+            # A near-duplicate photo was already parsed; skip the vision call.
+            math_problem = entry["math_problem"]
+            self.bill_cached(user_id, "gpt-4o", entry["parse"])
+        else:
+            with metrics.timed("parse_image"):
+                parsed = self.complete(self._parse_image_messages(image_bytes), "gpt-4o", user_id)
+            math_problem = parsed["content"]
+            if self.image_index:
+                self.image_index.add(image_hash, math_problem, parsed)
+
+        # Solving and recommending only depend on the parsed problem, so run them concurrently.
+        # With stream_solution the solution is returned as an unstarted generator of text deltas.
+        video_future = submit_in_context(executor, self.recommend_yt_video, math_problem, user_id)
+        if entry and entry["solution"]:
+            self.bill_cached(user_id, "gpt-4o", entry["solution"])
+            if stream_solution:
+                return math_problem, iter([entry["solution"]["content"]]), video_future
+            solution_future = Future()
+            solution_future.set_result(entry["solution"]["content"])
+        elif stream_solution:
+            return math_problem, self._stream_solve_and_index(image_hash, math_problem, user_id), video_future
+        else:
+            solution_future = submit_in_context(executor, self._solve_and_index, image_hash, math_problem, user_id)
+        return math_problem, solution_future, video_future
+
+    def _solve_and_index(self, image_hash, math_problem, user_id):
+        with metrics.timed("solve_math_problem"):
+            solution = self.complete(self._solve_messages(math_problem), "gpt-4o", user_id)
+        if self.image_index:
+            self.image_index.record_solution(image_hash, solution)
+        return solution["content"]
+
+    def _stream_solve_and_index(self, image_hash, math_problem, user_id):
+        with metrics.timed("solve_math_problem"):
+            solution = yield from self.stream_openai(self._solve_messages(math_problem), "gpt-4o", user_id)
+        if self.image_index:
+            self.image_index.record_solution(image_hash, solution)
 
 if __name__ == "__main__":
     math_assistant = MathAssistant()
@@ -0,0 +1,155 @@
+import bisect
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+# Stage timings of the request being handled, shared with worker threads through a copied context.
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self, namespace="mathbot", buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}  # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self._collectors = []  # (prefix, stats function)
+        self._trace_listeners = []
+
+    def describe(self, name, help_text):
+        self._help[f"{self.namespace}_{name}"] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(f"{self.namespace}_{name}", {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._histograms.setdefault(f"{self.namespace}_{name}", {})
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextlib.contextmanager
+    def timed(self, stage, **labels):
+        # Works as a context manager and as a method decorator.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("stage_duration_seconds", elapsed, stage=stage, **labels)
+            trace = _trace.get()
+            if trace is not None:
+                trace[stage] = trace.get(stage, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def trace(self, handler):
+        stages = {}
+        token = _trace.set(stages)
+        start = time.perf_counter()
+        try:
+            yield stages
+        finally:
+            _trace.reset(token)
+            elapsed = time.perf_counter() - start
+            self.observe("handler_duration_seconds", elapsed, handler=handler)
+            for listener in self._trace_listeners:
+                listener(handler, elapsed, stages)
+            if stages:
+                breakdown = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in stages.items())
+                self.logger.info(f"{handler} took {elapsed * 1000:.0f}ms ({breakdown})")
+
+    def add_collector(self, prefix, stats):
+        # Numeric values of stats() are exported as gauges named <namespace>_<prefix>_<key> at scrape time.
+        self._collectors.append((prefix, stats))
+
+    def add_trace_listener(self, listener):
+        # Called with (handler, seconds, stages) when a trace ends; benchmarks use it to keep raw samples.
+        self._trace_listeners.append(listener)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(entry) for key, entry in series.items()}
+                          for name, series in self._histograms.items()}
+
+        for name, series in sorted(counters.items()):
+            self._header(lines, name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, series in sorted(histograms.items()):
+            self._header(lines, name, "histogram")
+            for labels, entry in series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {entry[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {entry[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {entry[-1]}")
+
+        for prefix, stats in self._collectors:
+            try:
+                values = stats() or {}
+            except Exception as e:
+                self.logger.error(f"Error collecting {prefix} metrics: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.namespace}_{prefix}_{key}"
+                self._header(lines, name, "gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def submit_in_context(executor, func, *args, **kwargs):
+    # executor.submit() does not carry contextvars over; the copy keeps stage timings on the current trace.
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+metrics = Metrics()
+metrics.describe("stage_duration_seconds", "Time spent in each stage of handling a request.")
+metrics.describe("handler_duration_seconds", "Time spent in each Telegram handler.")
+metrics.describe("openai_tokens_total", "OpenAI tokens billed, by model and kind.")
+metrics.describe("openai_cost_usd_total", "Estimated OpenAI cost in USD, by model.")
+metrics.describe("openai_requests_total", "OpenAI requests, by model and whether they were served from cache.")
+metrics.describe("first_output_seconds", "Time until the first streamed text reached the user.")
+metrics.describe("admission_total", "Requests admitted, served or rejected at the webhook, by kind and outcome.")
+metrics.describe("scheduler_queued_total", "Requests that had to wait for a model slot, by lane.")
+metrics.describe("openai_request_seconds", "Latency of successful OpenAI requests, by model.")
+metrics.describe("openai_stream_open_seconds", "Time to open an OpenAI completion stream, by model.")
+metrics.describe("openai_errors_total", "Failed OpenAI requests, by model and error kind.")
+metrics.describe("openai_retries_total", "OpenAI requests retried after a 429, 5xx, timeout or connection error.")
+metrics.describe("openai_hedges_total", "Duplicate OpenAI requests sent because the first was slower than the hedge threshold.")
+metrics.describe("openai_fallbacks_total", "OpenAI calls answered by a fallback model, by model, fallback and reason.")
@@ -0,0 +1,305 @@
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+
+from metrics import metrics
+
+_client = None
+_lock = threading.Lock()
+
+# USD per million tokens: (prompt, completion). OPENAI_PRICING overrides entries, e.g. '{"gpt-4o": [2.5, 10]}'.
+DEFAULT_PRICING = {
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+
+def get_openai_client():
+    # One client (and one HTTP connection pool) per process, built on first use.
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI()
+    return _client
+
+
+def set_openai_client(client):
+    global _client
+    _client = client
+
+
+def parse_fallbacks(text):
+    # "gpt-4o:gpt-4o-mini,other:cheaper" -> {"gpt-4o": "gpt-4o-mini", "other": "cheaper"}
+    pairs = (item.split(":", 1) for item in text.split(",") if item.strip())
+    return {model.strip(): fallback.strip() for model, fallback in pairs}
+
+
+class PricingTable:
+    def __init__(self, prices=None):
+        self.prices = {**DEFAULT_PRICING, **{model: tuple(price) for model, price in (prices or {}).items()}}
+        self.logger = logging.getLogger(__name__)
+        self._unknown = set()
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text) if text else None)
+
+    def cost(self, model, prompt_tokens, completion_tokens=0):
+        price = self.prices.get(model)
+        if price is None:
+            if model not in self._unknown:
+                self._unknown.add(model)
+                self.logger.warning(f"No price for model {model}; its usage is recorded at no cost")
+            return 0.0
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1000000
+
+
+class ModelStats:
+    # Latencies of recent successful calls; samples older than `window` seconds are ignored, so a model
+    # that recovers (or stops being called) stops looking slow.
+    def __init__(self, window=300.0, max_samples=500):
+        self.window = window
+        self.counts = Counter()
+        self._samples = deque(maxlen=max_samples)  # (finished_at, seconds)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append((time.monotonic(), seconds))
+            self.counts["requests"] += 1
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def quantile(self, q, min_samples=1):
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            while self._samples and self._samples[0][0] < cutoff:
+                self._samples.popleft()
+            values = sorted(seconds for _, seconds in self._samples)
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats["latency_p50"] = self.quantile(0.5) or 0.0
+        stats["latency_p95"] = self.quantile(0.95) or 0.0
+        return stats
+
+
+def _error_kind(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return str(status)
+    name = type(error).__name__
+    if isinstance(error, TimeoutError) or "Timeout" in name:
+        return "timeout"
+    if "Connection" in name:
+        return "connection"
+    return "other"
+
+
+def _is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return _error_kind(error) in ("timeout", "connection")
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientOpenAI:
+    # Wraps the OpenAI client with deadlines, retries, hedging, model fallback and per-model stats.
+    # Every call gets `timeout` seconds in total, retries included; 429s, 5xx, timeouts and connection errors
+    # are retried with full-jitter exponential backoff. With hedging on, a non-streaming call still running
+    # after the model's recent p95 latency gets a duplicate request and the first answer wins (the loser is
+    # not cancelled, and OpenAI bills it). A model in `fallbacks` is swapped for its fallback while its p95
+    # is above `fallback_latency`, except one call in `probe_every`, and when it fails after all retries.
+    def __init__(self, client, pricing=None, timeout=60.0, max_retries=2, backoff_base=0.5, backoff_max=8.0,
+                 hedge=False, hedge_quantile=0.95, hedge_min_delay=1.0, hedge_workers=32, min_samples=20,
+                 fallbacks=None, fallback_latency=0.0, probe_every=10, stats_window=300.0):
+        # The SDK retries on its own by default; retries are done here so they share the call's deadline.
+        self.client = client.with_options(max_retries=0) if hasattr(client, "with_options") else client
+        self.pricing = pricing or PricingTable()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.min_samples = min_samples
+        self.fallbacks = fallbacks or {}
+        self.fallback_latency = fallback_latency
+        self.probe_every = probe_every
+        self.stats_window = stats_window
+        self.logger = logging.getLogger(__name__)
+        self._models = {}
+        self._models_lock = threading.Lock()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="openai-hedge") if hedge else None
+
+    def model_stats(self, model):
+        with self._models_lock:
+            stats = self._models.get(model)
+            if stats is None:
+                stats = self._models[model] = ModelStats(self.stats_window)
+            return stats
+
+    def complete(self, model, messages, **kwargs):
+        # Returns (model that answered, response).
+        def create(model, timeout):
+            return self.client.chat.completions.create(model=model, messages=messages, timeout=timeout, **kwargs)
+        return self._with_fallback(model, create, hedge=self.hedge, stream=False)
+
+    def stream(self, model, messages, **kwargs):
+        # Only opening the stream is retried; once text has reached the user a failure is final.
+        def create(model, timeout):
+            return self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, timeout=timeout, **kwargs
+            )
+        return self._with_fallback(model, create, hedge=False, stream=True)
+
+    def embed(self, model, input, **kwargs):
+        def create(model, timeout):
+            return self.client.embeddings.create(input=input, model=model, timeout=timeout, **kwargs)
+        return self._call(model, functools.partial(create, model), time.monotonic() + self.timeout, self.hedge, False)
+
+    def _with_fallback(self, model, create, hedge, stream):
+        deadline = time.monotonic() + self.timeout
+        chosen = self._select_model(model)
+        try:
+            return chosen, self._call(chosen, functools.partial(create, chosen), deadline, hedge, stream)
+        except Exception as e:
+            fallback = self.fallbacks.get(chosen)
+            if not fallback or not _is_retryable(e) or time.monotonic() >= deadline:
+                raise
+            self._count_fallback(chosen, fallback, "error")
+            return fallback, self._call(fallback, functools.partial(create, fallback), deadline, hedge, stream)
+
+    def _select_model(self, model):
+        fallback = self.fallbacks.get(model)
+        if not fallback or not self.fallback_latency:
+            return model
+        stats = self.model_stats(model)
+        p95 = stats.quantile(0.95, self.min_samples)
+        if p95 is None or p95 <= self.fallback_latency:
+            return model
+        stats.count("pressure_calls")
+        if stats.counts["pressure_calls"] % self.probe_every == 0:
+            return model
+        self._count_fallback(model, fallback, "latency")
+        return fallback
+
+    def _count_fallback(self, model, fallback, reason):
+        self.model_stats(model).count(f"fallbacks_{reason}")
+        metrics.inc("openai_fallbacks_total", model=model, fallback=fallback, reason=reason)
+        self.logger.warning(f"Using {fallback} instead of {model} ({reason})")
+
+    def _call(self, model, create, deadline, hedge, stream):
+        stats = self.model_stats(model)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                stats.count("deadline_exceeded")
+                raise TimeoutError(f"{model} call exceeded its {self.timeout}s deadline")
+            try:
+                if hedge:
+                    return self._hedged(model, create, remaining)
+                return self._attempt(model, create, remaining, stream)
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                delay = max(delay, _retry_after(e) or 0.0)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                stats.count("retries")
+                metrics.inc("openai_retries_total", model=model)
+                self.logger.warning(f"{model} call failed ({_error_kind(e)}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+    def _attempt(self, model, create, timeout, stream=False):
+        stats = self.model_stats(model)
+        start = time.monotonic()
+        try:
+            response = create(timeout)
+        except Exception as e:
+            kind = _error_kind(e)
+            stats.count("errors")
+            stats.count(f"errors_{kind}")
+            metrics.inc("openai_errors_total", model=model, kind=kind)
+            raise
+        seconds = time.monotonic() - start
+        if stream:
+            # Opening a stream takes about the time to first token; kept apart from full-response latencies.
+            stats.count("streams")
+            metrics.observe("openai_stream_open_seconds", seconds, model=model)
+        else:
+            stats.record(seconds)
+            metrics.observe("openai_request_seconds", seconds, model=model)
+        return response
+
+    def _hedged(self, model, create, remaining):
+        stats = self.model_stats(model)
+        delay = stats.quantile(self.hedge_quantile, self.min_samples)
+        if delay is None or max(delay, self.hedge_min_delay) >= remaining:
+            return self._attempt(model, create, remaining)
+        delay = max(delay, self.hedge_min_delay)
+        deadline = time.monotonic() + remaining
+        primary = self._hedge_pool.submit(self._attempt, model, create, remaining)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        stats.count("hedges")
+        metrics.inc("openai_hedges_total", model=model)
+        backup = self._hedge_pool.submit(self._attempt, model, create, deadline - time.monotonic())
+        errors = []
+        try:
+            for future in as_completed([primary, backup], timeout=deadline - time.monotonic()):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if future is backup:
+                    stats.count("hedge_wins")
+                return response
+        except FutureTimeout:
+            stats.count("deadline_exceeded")
+            raise TimeoutError(f"{model} call exceeded its {self.timeout}s deadline")
+        raise errors[0]
+
+    def stats(self):
+        with self._models_lock:
+            models = dict(self._models)
+        stats = {}
+        for model, model_stats in models.items():
+            # Collector keys become Prometheus metric names, which allow no dashes or dots.
+            prefix = model.replace("-", "_").replace(".", "_")
+            for key, value in model_stats.stats().items():
+                stats[f"{prefix}_{key}"] = value
+        return stats
+
+    def close(self):
+        if self._hedge_pool:
+            self._hedge_pool.shutdown(wait=False)
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_messages(messages):
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+    return [normalize(message) for message in messages]
+
+
+def make_key(model, messages):
+    # user_id is deliberately not part of the key so identical problems share a hit.
+    payload = json.dumps([model, normalize_messages(messages)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._size -= len(key) + len(value)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "evictions": self.evictions}
+
+
+class SQLiteCacheBackend:
+    # A local file shared by every worker process on the host and kept across restarts.
+    def __init__(self, path, max_bytes, ttl, table="response_cache"):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_last_access ON {self.table} (last_access)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_expires_at ON {self.table} (expires_at)')
+            # Running totals kept by triggers in the writing transaction, so checking the budget is one row read.
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.table}_totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    entries INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {self.table}_totals_insert AFTER INSERT ON {self.table} BEGIN
+                    UPDATE {self.table}_totals SET entries = entries + 1, bytes = bytes + NEW.size;
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {self.table}_totals_update AFTER UPDATE OF size ON {self.table} BEGIN
+                    UPDATE {self.table}_totals SET bytes = bytes + NEW.size - OLD.size;
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {self.table}_totals_delete AFTER DELETE ON {self.table} BEGIN
+                    UPDATE {self.table}_totals SET entries = entries - 1, bytes = bytes - OLD.size;
+                END
+            ''')
+            # A cache file from before the totals table is summed once; the triggers already exist by then.
+            conn.execute(f'''
+                INSERT OR IGNORE INTO {self.table}_totals (id, entries, bytes)
+                SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}
+            ''')
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                self.evictions += 1
+                return None
+            conn.execute(f'UPDATE {self.table} SET last_access = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._connection() as conn:
+            # An upsert rather than INSERT OR REPLACE: the implicit delete of a replace does not fire triggers.
+            conn.execute(f'''
+                INSERT INTO {self.table} (key, value, size, expires_at, last_access)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    value = excluded.value, size = excluded.size,
+                    expires_at = excluded.expires_at, last_access = excluded.last_access
+            ''', (key, value, size, now + self.ttl, now))
+            self.evictions += conn.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (now,)).rowcount
+            total = conn.execute(f'SELECT bytes FROM {self.table}_totals').fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(conn, total - self.max_bytes)
+
+    def _evict(self, conn, excess):
+        freed = 0
+        victims = []
+        for key, size in conn.execute(f'SELECT key, size FROM {self.table} ORDER BY last_access'):
+            if freed >= excess:
+                break
+            victims.append((key,))
+            freed += size
+        conn.executemany(f'DELETE FROM {self.table} WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+        with self._connection() as conn:
+            entries, size = conn.execute(f'SELECT entries, bytes FROM {self.table}_totals').fetchone()
+        return {"entries": entries, "bytes": size, "evictions": self.evictions}
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, messages):
+        value = self.backend.get(make_key(model, messages))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, model, messages, entry):
+        self.backend.set(make_key(model, messages), json.dumps(entry).encode("utf-8"))
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        lookups = self.hits + self.misses
+        stats["hit_rate"] = self.hits / lookups if lookups else 0.0
+        return stats
+
+
+def create_response_cache(backend, path, max_bytes, ttl):
+    if backend == "memory":
+        return ResponseCache(MemoryCacheBackend(max_bytes, ttl))
+    if backend == "sqlite":
+        return ResponseCache(SQLiteCacheBackend(path, max_bytes, ttl))
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown response cache backend: {backend}")
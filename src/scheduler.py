@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from metrics import metrics
+
+
+class Rejected(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount):
+        self._refill(time.monotonic())
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+class FairScheduler:
+    # Grants up to `capacity` concurrent slots, at most `per_user` of them to one user. Waiting users
+    # are served round-robin, so a user with many queued requests cannot starve the others.
+    def __init__(self, capacity, per_user=1, name="default"):
+        self.name = name
+        self.capacity = capacity
+        self.per_user = per_user
+        self._in_use = 0
+        self._active = {}  # user_id -> slots held
+        self._waiting = OrderedDict()  # user_id -> deque of futures, in round-robin order
+        self._stats = {"granted": 0, "queued": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    def _can_run(self, user_id):
+        return self._in_use < self.capacity and self._active.get(user_id, 0) < self.per_user
+
+    async def acquire(self, user_id):
+        if user_id not in self._waiting and self._can_run(user_id):
+            self._grant(user_id)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self._stats["queued"] += 1
+        metrics.inc("scheduler_queued_total", lane=self.name)
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(user_id)
+            else:
+                self._forget(user_id, future)
+            raise
+        waited = time.monotonic() - start
+        self._stats["wait_time_total"] += waited
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+    def release(self, user_id):
+        self._in_use -= 1
+        self._active[user_id] -= 1
+        if not self._active[user_id]:
+            del self._active[user_id]
+        self._dispatch()
+
+    def _grant(self, user_id):
+        self._in_use += 1
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        self._stats["granted"] += 1
+
+    def _dispatch(self):
+        for user_id in list(self._waiting):
+            if self._in_use >= self.capacity:
+                return
+            if not self._can_run(user_id):
+                continue
+            waiters = self._waiting.pop(user_id)
+            future = waiters.popleft()
+            if waiters:
+                # Back of the line until every other waiting user has had a turn.
+                self._waiting[user_id] = waiters
+            self._grant(user_id)
+            future.set_result(None)
+
+    def _forget(self, user_id, future):
+        waiters = self._waiting.get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiting[user_id]
+
+    def slot(self, user_id):
+        return _Slot(self, user_id)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["in_use"] = self._in_use
+        stats["capacity"] = self.capacity
+        stats["waiting"] = sum(len(waiters) for waiters in self._waiting.values())
+        stats["waiting_users"] = len(self._waiting)
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["queued"] if stats["queued"] else 0.0
+        return stats
+
+
+class _Slot:
+    def __init__(self, scheduler, user_id):
+        self.scheduler = scheduler
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.user_id)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self.user_id)
+
+
+class AdmissionController:
+    # Decides at webhook time, without any I/O, whether an update may enter the queue.
+    def __init__(self, balance_lookup, rate=0.2, burst=5, costs=None, token_estimates=None,
+                 max_pending_per_user=3, per_user_concurrency=1, lanes=None):
+        self.balance_lookup = balance_lookup  # user_id -> available tokens, or None when unknown
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs or {"image": 2, "text": 1}
+        self.token_estimates = token_estimates or {"image": 3000, "text": 800}
+        self.max_pending_per_user = max_pending_per_user
+        self.lanes = {name: FairScheduler(capacity, per_user_concurrency, name) for name, capacity in (lanes or {}).items()}
+        self.logger = logging.getLogger(__name__)
+        self._buckets = {}
+        self._pending = {}  # user_id -> updates admitted but not finished
+        self._reserved = {}  # user_id -> tokens those updates are expected to use
+        self._stats = {"admitted": 0, "served": 0, "rejected_rate_limited": 0,
+                       "rejected_too_many_pending": 0, "rejected_no_tokens": 0}
+
+    def admit(self, user_id, kind):
+        if self._pending.get(user_id, 0) >= self.max_pending_per_user:
+            self._reject(user_id, kind, "too_many_pending")
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.try_take(self.costs.get(kind, 1)):
+            self._reject(user_id, kind, "rate_limited")
+        # Requests already admitted count against the balance before their usage is logged.
+        estimate = self.token_estimates.get(kind, 0)
+        available = self.balance_lookup(user_id)
+        if available is not None and available - self._reserved.get(user_id, 0) < estimate:
+            self._reject(user_id, kind, "no_tokens")
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._reserved[user_id] = self._reserved.get(user_id, 0) + estimate
+        self._stats["admitted"] += 1
+        metrics.inc("admission_total", kind=kind, outcome="admitted")
+
+    def _reject(self, user_id, kind, reason):
+        self._stats[f"rejected_{reason}"] += 1
+        metrics.inc("admission_total", kind=kind, outcome=reason)
+        self.logger.info(f"Rejected {kind} request from user {user_id}: {reason}")
+        raise Rejected(reason)
+
+    def done(self, user_id, kind):
+        self._pending[user_id] -= 1
+        self._reserved[user_id] -= self.token_estimates.get(kind, 0)
+        if not self._pending[user_id]:
+            del self._pending[user_id]
+            del self._reserved[user_id]
+        self._stats["served"] += 1
+        metrics.inc("admission_total", kind=kind, outcome="served")
+        if len(self._buckets) > 10000:
+            self._prune_buckets()
+
+    def _prune_buckets(self):
+        for user_id in [user_id for user_id, bucket in self._buckets.items()
+                        if bucket.is_full() and user_id not in self._pending]:
+            del self._buckets[user_id]
+
+    def slot(self, lane, user_id):
+        return self.lanes[lane].slot(user_id)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = sum(self._pending.values())
+        stats["pending_users"] = len(self._pending)
+        for name, lane in self.lanes.items():
+            # Collector keys become Prometheus metric names, which allow no dashes.
+            prefix = name.replace("-", "_").replace(".", "_")
+            for key, value in lane.stats().items():
+                stats[f"{prefix}_{key}"] = value
+        return stats
@@ -0,0 +1,58 @@
+import logging
+import sqlite3
+
+
+class SQLiteCloudBackend:
+    name = "cloud"
+    supports_vec = True
+
+    def __init__(self, api_key, db_name, host):
+        self.api_key = api_key
+        self.db_name = db_name
+        self.host = host
+
+    def connect(self):
+        import sqlitecloud
+        conn = sqlitecloud.connect(f"sqlitecloud://{self.host}?apikey={self.api_key}")
+        conn.execute(f"USE DATABASE {self.db_name}")
+        return conn
+
+
+class LocalSQLiteBackend:
+    # An embedded database file: no network round trip per query. WAL lets readers and the writer overlap.
+    name = "local"
+
+    def __init__(self, path):
+        self.path = path
+        self.supports_vec = None  # known after the first connection
+        self.logger = logging.getLogger(__name__)
+
+    def connect(self):
+        # Autocommit mode: DatabaseManager issues BEGIN/COMMIT itself.
+        conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        if self.supports_vec is not False:
+            self.supports_vec = self._load_vec(conn)
+        return conn
+
+    def _load_vec(self, conn):
+        try:
+            import sqlite_vec
+            conn.enable_load_extension(True)
+            sqlite_vec.load(conn)
+            conn.enable_load_extension(False)
+            return True
+        except (ImportError, AttributeError, sqlite3.Error) as e:
+            # Without vec0 the embeddings are kept as plain blobs and searched by the in-process vector index.
+            self.logger.warning(f"sqlite-vec not available ({e}); use VECTOR_INDEX_ENABLED for recommendations")
+            return False
+
+
+def create_storage_backend(backend, api_key=None, db_name=None, host=None, path=None):
+    if backend == "cloud":
+        return SQLiteCloudBackend(api_key, db_name, host)
+    if backend == "local":
+        return LocalSQLiteBackend(path)
+    raise ValueError(f"Unknown storage backend: {backend}")
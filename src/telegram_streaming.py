@@ -0,0 +1,109 @@
+import asyncio
+import contextvars
+import logging
+import time
+from telegram.error import BadRequest, RetryAfter
+
+TELEGRAM_MAX_LENGTH = 4096
+_DONE = object()
+
+
+async def iterate_in_executor(executor, generator):
+    # Runs a blocking generator on a worker thread and hands its items to the event loop as they arrive.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def pump():
+        try:
+            for item in generator:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+    future = loop.run_in_executor(executor, contextvars.copy_context().run, pump)
+    while True:
+        item = await queue.get()
+        if item is _DONE:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    await future
+
+
+class StreamingReply:
+    # Posts the reply once there is something worth reading, then edits it at most every edit_interval
+    # seconds; Telegram throttles edits per chat and rejects messages over 4096 characters.
+    def __init__(self, message, edit_interval=1.5, min_chars=40, max_length=TELEGRAM_MAX_LENGTH - 96):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.max_length = max_length
+        self.logger = logging.getLogger(__name__)
+        self.text = ""
+        self._current = None  # the message being edited
+        self._shown = ""
+        self._offset = 0  # where the text shown in _current starts
+        self._last_edit = 0.0
+        self.first_output_at = None
+        self.messages = 0
+        self.edits = 0
+
+    async def append(self, delta):
+        self.text += delta
+        if self._current is None and not self.messages:
+            if len(self.text.strip()) >= self.min_chars:
+                await self._flush()
+        elif time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._flush()
+
+    async def finish(self):
+        if self.text.strip():
+            await self._flush(final=True)
+        return self.text.strip()
+
+    async def stream(self, chunks):
+        async for delta in chunks:
+            await self.append(delta)
+        return await self.finish()
+
+    async def _flush(self, final=False):
+        while len(self.text) - self._offset > self.max_length:
+            # Close the current message at a line break and continue in a new one.
+            end = self.text.rfind("\n", self._offset, self._offset + self.max_length)
+            if end <= self._offset:
+                end = self._offset + self.max_length
+            await self._show(self.text[self._offset:end])
+            self._current, self._shown = None, ""
+            self._offset = end
+        tail = self.text[self._offset:]
+        await self._show(tail if final else tail + " …")
+
+    async def _show(self, text):
+        text = text.strip()
+        if not text or text == self._shown:
+            return
+        if self._current is None:
+            self._current = await self._call(self.message.reply_text, text)
+            self.messages += 1
+            if self.first_output_at is None:
+                self.first_output_at = time.monotonic()
+        else:
+            await self._call(self._current.edit_text, text)
+            self.edits += 1
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def _call(self, method, text):
+        try:
+            return await method(text)
+        except RetryAfter as e:
+            self.logger.warning(f"Telegram flood control, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds())
+            return await method(text)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return None
+            raise
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UpdateQueue:
+    def __init__(self, process, maxsize=200, workers=8, dedupe_size=10000):
+        self._process = process
+        self.maxsize = maxsize
+        self.workers = workers
+        self.dedupe_size = dedupe_size
+        self.logger = logging.getLogger(__name__)
+        # Updates of one chat wait in their own deque; a chat is in _ready at most once,
+        # so a single worker handles it at a time and its updates keep their order.
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._seen = OrderedDict()
+        self._depth = 0
+        self._tasks = []
+        self._busy = 0
+        self._stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "max_depth": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "processing_time_total": 0.0,
+        }
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    def submit(self, update, admit=None):
+        # admit() runs only for updates that would be queued, so retries and overflow never reach it;
+        # an exception from it rejects the update.
+        if update.update_id in self._seen:
+            self._stats["duplicates"] += 1
+            return False
+        if self._depth >= self.maxsize:
+            self._stats["rejected"] += 1
+            raise QueueFull(f"Update queue is full ({self.maxsize})")
+        if admit:
+            admit()
+
+        self._seen[update.update_id] = None
+        if len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+
+        chat = update.effective_chat.id if update.effective_chat else f"update:{update.update_id}"
+        pending = self._chats.get(chat)
+        if pending is None:
+            pending = self._chats[chat] = deque()
+            self._ready.put_nowait(chat)
+        pending.append((update, time.monotonic()))
+        self._depth += 1
+        self._stats["enqueued"] += 1
+        self._stats["max_depth"] = max(self._stats["max_depth"], self._depth)
+        return True
+
+    async def _worker(self, number):
+        while True:
+            chat = await self._ready.get()
+            pending = self._chats[chat]
+            update, enqueued_at = pending.popleft()
+            self._depth -= 1
+            waited = time.monotonic() - enqueued_at
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+            self._busy += 1
+            start = time.monotonic()
+            try:
+                await self._process(update)
+                self._stats["processed"] += 1
+            except Exception as e:
+                self._stats["failed"] += 1
+                self.logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self._busy -= 1
+                self._stats["processing_time_total"] += time.monotonic() - start
+                if pending:
+                    self._ready.put_nowait(chat)
+                else:
+                    del self._chats[chat]
+                self._ready.task_done()
+
+    async def stop(self, timeout=30.0):
+        # Let queued updates finish, then stop the workers.
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Stopping with {self._depth} updates still queued")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["depth"] = self._depth
+        stats["capacity"] = self.maxsize
+        stats["chats_waiting"] = len(self._chats)
+        stats["workers"] = self.workers
+        stats["workers_busy"] = self._busy
+        started = stats["processed"] + stats["failed"] + self._busy
+        stats["wait_time_avg"] = stats["wait_time_total"] / started if started else 0.0
+        done = stats["processed"] + stats["failed"]
+        stats["processing_time_avg"] = stats["processing_time_total"] / done if done else 0.0
+        return stats
@@ -0,0 +1,180 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class UsageBuffer:
+    def __init__(self, write_rows, spool_path=None, batch_size=50, flush_interval=2.0):
+        self._write_rows = write_rows
+        # Each worker process spools to its own file next to the configured path, so no worker
+        # rewrites rows another one has not flushed yet.
+        self.base_spool_path = spool_path
+        root, ext = os.path.splitext(spool_path) if spool_path else (None, None)
+        self.spool_path = f"{root}.{os.getpid()}{ext}" if spool_path else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger(__name__)
+        self._pending = deque()
+        self._inflight = []
+        self._lock = threading.Lock()
+        # Held while a batch is committed so balance reads never see it twice or not at all.
+        self.commit_lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._spool = None
+        self._stats = {
+            "appended": 0,
+            "flushed_rows": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+            "replayed_rows": 0,
+            "claimed_spools": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+            "total_flush_latency": 0.0,
+        }
+
+    def start(self):
+        if self.spool_path:
+            self._claim_orphaned_spools()
+        self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+        self._thread.start()
+
+    def _claim_orphaned_spools(self):
+        # Adopt the spools of workers that are gone (and the pre-pid shared spool). The rows are copied
+        # into this worker's spool before the old file is removed, all under a lock shared by the workers.
+        # Rows may be replayed after they were committed; the ledger skips row_ids it already has.
+        root, ext = os.path.splitext(self.base_spool_path)
+        with open(f"{self.base_spool_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            orphans = [self.base_spool_path] if os.path.exists(self.base_spool_path) else []
+            for path in glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}"):
+                pid = path[len(root) + 1:len(path) - len(ext)]
+                if pid.isdigit() and (int(pid) == os.getpid() or not _process_alive(int(pid))):
+                    orphans.append(path)
+            for path in orphans:
+                self._pending.extend(self._read_spool(path))
+            self._spool = open(self.spool_path, "a", encoding="utf-8")
+            if orphans:
+                self._rewrite_spool()
+                for path in orphans:
+                    if path != self.spool_path:
+                        os.remove(path)
+        self._stats["claimed_spools"] = len(orphans)
+        self._stats["replayed_rows"] = len(self._pending)
+        if self._pending:
+            self.logger.info(f"Replayed {len(self._pending)} unflushed usage rows from {len(orphans)} spool(s)")
+
+    def _read_spool(self, path):
+        rows = []
+        with open(path, encoding="utf-8") as spool:
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rows.append(tuple(json.loads(line)))
+                except ValueError:
+                    self.logger.warning(f"Skipping corrupt usage spool line in {path}: {line!r}")
+        return rows
+
+    def append(self, row):
+        with self._lock:
+            self._pending.append(row)
+            self._stats["appended"] += 1
+            if self._spool:
+                self._spool.write(json.dumps(row) + "\n")
+                self._spool.flush()
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def pending_delta(self, user_id):
+        with self._lock:
+            rows = [row for row in list(self._pending) + self._inflight if row[0] == user_id]
+        return sum(row[3] for row in rows), sum(row[4] for row in rows)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error flushing usage buffer: {e}")
+
+    def flush(self):
+        while True:
+            with self.commit_lock:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    batch_size = min(self.batch_size, len(self._pending))
+                    self._inflight = [self._pending.popleft() for _ in range(batch_size)]
+                start = time.monotonic()
+                try:
+                    self._write_rows(self._inflight)
+                except Exception:
+                    with self._lock:
+                        self._pending.extendleft(reversed(self._inflight))
+                        self._inflight = []
+                        self._stats["flush_failures"] += 1
+                    raise
+                latency = time.monotonic() - start
+                with self._lock:
+                    self._stats["flushes"] += 1
+                    self._stats["flushed_rows"] += len(self._inflight)
+                    self._stats["last_flush_latency"] = latency
+                    self._stats["max_flush_latency"] = max(self._stats["max_flush_latency"], latency)
+                    self._stats["total_flush_latency"] += latency
+                    self._inflight = []
+                    self._rewrite_spool()
+
+    def _rewrite_spool(self):
+        if not self._spool:
+            return
+        tmp_path = f"{self.spool_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for row in self._pending:
+                tmp.write(json.dumps(row) + "\n")
+        self._spool.close()
+        os.replace(tmp_path, self.spool_path)
+        self._spool = open(self.spool_path, "a", encoding="utf-8")
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            if self._spool:
+                self._spool.close()
+                self._spool = None
+                if not self._pending:
+                    os.remove(self.spool_path)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._pending)
+            stats["inflight"] = len(self._inflight)
+        flushes = stats["flushes"]
+        stats["avg_flush_latency"] = stats["total_flush_latency"] / flushes if flushes else 0.0
+        return stats
@@ -1,11 +1,5 @@
 import subprocess
-import pandas as pd
-from openai import OpenAI
-from config import Config
-
-config = Config()
-config.set_config()
-client = OpenAI()
+from openai_client import get_openai_client
 
 # TODO: This maybe belongs outside src or in databaseManage with an UPSERT
 def get_videos():
@@ -23,9 +17,18 @@ def get_videos():
 
 # TODO: create a class to be used in databaseManager and mathAssistant OpenAIUtils with raw funcionalities openAI
 def get_embedding(text):
-    response = client.embeddings.create(
+    response = get_openai_client().embeddings.create(
         input=text,
         model="text-embedding-3-large"
     )
     embedding = response.data[0].embedding
     return embedding
+
+
+def get_embeddings(texts, model="text-embedding-3-large"):
+    # The embeddings endpoint takes a list and returns vectors in input order.
+    response = get_openai_client().embeddings.create(
+        input=list(texts),
+        model=model
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+from embedding_quantization import decode_embedding, reduce_dimensions
+
+
+class VectorIndex:
+    def __init__(self, ids, urls, descriptions, matrix, signature=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.urls = list(urls)
+        self.descriptions = list(descriptions)
+        self.matrix = matrix
+        self.signature = signature
+
+    @classmethod
+    def from_rows(cls, rows, signature=None, dimensions=None):
+        ids, urls, descriptions, vectors = [], [], [], []
+        for video_id, url, description, embedding in rows:
+            ids.append(video_id)
+            urls.append(url)
+            descriptions.append(description)
+            vectors.append(decode_embedding(embedding))
+        if vectors:
+            matrix = np.vstack(vectors)
+            matrix = np.ascontiguousarray(reduce_dimensions(matrix, dimensions or matrix.shape[1]), dtype=np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        return cls(ids, urls, descriptions, matrix, signature)
+
+    def save(self, path):
+        # Write next to the target and swap in, so a live memory map is never truncated underneath us.
+        with open(f"{path}.npy.tmp", "wb") as matrix_file:
+            np.save(matrix_file, self.matrix)
+        with open(f"{path}.json.tmp", "w", encoding="utf-8") as metadata:
+            json.dump({
+                "ids": self.ids.tolist(),
+                "urls": self.urls,
+                "descriptions": self.descriptions,
+                "signature": self.signature,
+            }, metadata, ensure_ascii=False)
+        os.replace(f"{path}.npy.tmp", f"{path}.npy")
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(f"{path}.json", encoding="utf-8") as metadata:
+            meta = json.load(metadata)
+        matrix = np.load(f"{path}.npy", mmap_mode="r" if mmap else None)
+        signature = tuple(meta["signature"]) if meta.get("signature") else None
+        return cls(meta["ids"], meta["urls"], meta["descriptions"], matrix, signature)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, limit=5):
+        if not len(self):
+            return []
+        query = reduce_dimensions(query, self.matrix.shape[1])
+        similarities = self.matrix @ query
+        limit = min(limit, len(similarities))
+        top = np.argpartition(-similarities, limit - 1)[:limit]
+        top = top[np.argsort(-similarities[top], kind="stable")]
+        # Report L2 distance between unit vectors, the same metric vec0 orders by.
+        distances = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * similarities[top]))
+        return [
+            (int(self.ids[i]), float(distance), self.urls[i], self.descriptions[i])
+            for i, distance in zip(top, distances)
+        ]
+
+
+class VideoVectorIndex:
+    def __init__(self, db_manager, path=None, mmap=True, refresh_interval=300.0, dimensions=None):
+        self.db_manager = db_manager
+        self.dimensions = dimensions
+        self.path = path
+        self.mmap = mmap
+        self.refresh_interval = refresh_interval
+        self.logger = logging.getLogger(__name__)
+        self.index = None
+        self._checked_at = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def _signature(self):
+        return tuple(self.db_manager.get_video_catalog_signature()) + (self.dimensions,)
+
+    def load(self):
+        signature = self._signature()
+        if self.path and os.path.exists(f"{self.path}.npy"):
+            index = VectorIndex.load(self.path, mmap=self.mmap)
+            if index.signature == signature:
+                self.index = index
+                self._checked_at = time.monotonic()
+                self.logger.info(f"Loaded {len(index)} video vectors from {self.path}")
+                return
+        self._rebuild(signature)
+
+    def _rebuild(self, signature):
+        index = VectorIndex.from_rows(self.db_manager.get_video_catalog(), signature, self.dimensions)
+        if self.path:
+            index.save(self.path)
+            if self.mmap:
+                index = VectorIndex.load(self.path, mmap=True)
+        self.index = index
+        self._checked_at = time.monotonic()
+        self.logger.info(f"Built in-process vector index with {len(index)} videos")
+
+    def refresh(self, force=False):
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            signature = self._signature()
+            if force or self.index is None or signature != self.index.signature:
+                self._rebuild(signature)
+        finally:
+            self._refresh_lock.release()
+
+    def search(self, query, limit=5):
+        if self.index is None:
+            self.load()
+        elif time.monotonic() - self._checked_at > self.refresh_interval:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.warning(f"Vector index refresh failed, serving the current index: {e}")
+        return self.index.search(query, limit)
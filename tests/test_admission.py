@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from telegram import Update
+
+import main
+from scheduler import AdmissionController
+from update_queue import UpdateQueue
+
+
+def make_bot(processed, balance=None):
+    # Only the parts of MathBot that enqueue_update and process_update touch.
+    async def process_update(update):
+        await asyncio.sleep(0.01)
+        processed.append(update.update_id)
+
+    bot = main.MathBot.__new__(main.MathBot)
+    bot.logger = logging.getLogger("test")
+    bot.application = SimpleNamespace(process_update=process_update)
+    bot.admission = AdmissionController(lambda user_id: balance, rate=0.0, burst=100, max_pending_per_user=3)
+    bot.admitted = {}
+    bot.handler_errors = {}
+    bot.busy_replies = set()
+    bot.update_queue = UpdateQueue(bot.process_update, maxsize=10, workers=2)
+    return bot
+
+
+def text_update(update_id, user_id=42):
+    user = {"id": user_id, "is_bot": False, "first_name": "Ana"}
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": "¿Cuánto es 2 + 2?",
+        },
+    }, None)
+
+
+def test_retried_update_is_admitted_once():
+    processed = []
+
+    async def run():
+        bot = make_bot(processed)
+        await bot.update_queue.start()
+        assert bot.enqueue_update(text_update(7))
+        # Telegram retries the webhook while the first delivery is still queued or running.
+        for _ in range(5):
+            assert not bot.enqueue_update(text_update(7))
+        assert bot.admission._pending == {42: 1}
+        await bot.update_queue.stop()
+        return bot
+
+    bot = asyncio.run(run())
+    assert processed == [7]
+    assert bot.admitted == {}
+    assert bot.admission._pending == {}
+    assert bot.admission._reserved == {}
+    assert bot.admission.stats()["admitted"] == 1
+    assert bot.admission.stats()["served"] == 1
+
+
+def test_retry_after_processing_does_not_leak_reservations():
+    processed = []
+
+    async def run():
+        bot = make_bot(processed, balance=10000)
+        await bot.update_queue.start()
+        assert bot.enqueue_update(text_update(8))
+        await asyncio.sleep(0.05)
+        assert not bot.enqueue_update(text_update(8))
+        # The user can keep sending messages afterwards.
+        for update_id in (9, 10, 11):
+            assert bot.enqueue_update(text_update(update_id))
+        await bot.update_queue.stop()
+        return bot
+
+    bot = asyncio.run(run())
+    assert processed == [8, 9, 10, 11]
+    assert bot.admission._pending == {}
+    assert bot.admission._reserved == {}
+
+
+def test_handler_errors_count_as_failed():
+    processed = []
+
+    async def run():
+        bot = make_bot(processed)
+
+        async def process_update(update):
+            # Like Application.process_update: the handler's exception goes to the error handlers, not the caller.
+            try:
+                raise ValueError("boom")
+            except ValueError as e:
+                await bot.handler_error(update, SimpleNamespace(error=e))
+
+        bot.application = SimpleNamespace(process_update=process_update)
+        await bot.update_queue.start()
+        assert bot.enqueue_update(text_update(12))
+        await bot.update_queue.stop()
+        return bot
+
+    bot = asyncio.run(run())
+    assert bot.update_queue.stats()["failed"] == 1
+    assert bot.update_queue.stats()["processed"] == 0
+    assert bot.handler_errors == {}
+    assert bot.admission._pending == {}
+
+
+def test_busy_replies_are_kept_until_sent():
+    processed = []
+    sent = []
+
+    async def run():
+        bot = make_bot(processed)
+        bot.update_queue = UpdateQueue(bot.process_update, maxsize=1, workers=1)
+
+        async def send_message(chat_id, text):
+            await asyncio.sleep(0.01)
+            sent.append(chat_id)
+
+        bot.application = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+        assert bot.enqueue_update(text_update(20, user_id=1))
+        assert not bot.enqueue_update(text_update(21, user_id=2))
+        assert len(bot.busy_replies) == 1
+        await asyncio.gather(*bot.busy_replies)
+        return bot
+
+    bot = asyncio.run(run())
+    assert sent == [2]
+    assert bot.busy_replies == set()
@@ -0,0 +1,39 @@
+from balance_cache import MISSING, BalanceCache
+from database import DatabaseManager
+from storage import LocalSQLiteBackend
+
+
+def test_usage_logged_during_a_read_is_not_lost(tmp_path):
+    db_manager = DatabaseManager("test", "test", backend=LocalSQLiteBackend(str(tmp_path / "test.sqlite")))
+    db_manager.initialize_database()
+    db_manager.log_openai_usage(7, "INITIAL_TOKENS", -20000, 0)
+    db_manager.start_usage_writer(spool_path=str(tmp_path / "usage_spool.jsonl"), flush_interval=60)
+    buffer = db_manager.usage_buffer
+    pending_delta = buffer.pending_delta
+
+    def racing_pending_delta(user_id):
+        # Another request logs usage after the buffer was read but before the balance is cached.
+        delta = pending_delta(user_id)
+        buffer.pending_delta = pending_delta
+        db_manager.log_openai_usage(user_id, "gpt-4o", 500, 0.01)
+        return delta
+
+    buffer.pending_delta = racing_pending_delta
+    assert db_manager.get_user_usage(7)[0] == -20000
+    assert db_manager.balance_cache.peek(7) is MISSING
+    assert db_manager.get_user_usage(7)[0] == -19500
+    assert db_manager.balance_cache.peek(7)[0] == -19500
+    db_manager.close()
+
+
+def test_reads_started_before_a_forgotten_change_are_dropped():
+    cache = BalanceCache(maxsize=2)
+    generation = cache.generation()
+    for user_id in (1, 2, 3):
+        cache.apply_delta(user_id, 10, 0.0)
+    # User 1 no longer has its own stamp, so the read counts as stale.
+    cache.set(1, (0, 0.0), generation)
+    assert cache.peek(1) is MISSING
+    cache.set(1, (10, 0.0), cache.generation())
+    assert cache.peek(1) == (10, 0.0)
+    assert cache.stats()["stale_reads"] == 1
@@ -0,0 +1,40 @@
+import numpy as np
+
+import database
+from database import DatabaseManager
+from storage import LocalSQLiteBackend
+
+
+def fake_embeddings(texts):
+    return [np.full(3072, len(text), dtype=np.float32).tolist() for text in texts]
+
+
+def test_videos_without_an_embedding_are_reembedded(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "get_embeddings", fake_embeddings)
+    csv_file = tmp_path / "videos.csv"
+    csv_file.write_text("https://youtu.be/a,Ecuaciones\nhttps://youtu.be/b,Derivadas\n", encoding="utf-8")
+    db_manager = DatabaseManager("test", "test", backend=LocalSQLiteBackend(str(tmp_path / "test.sqlite")))
+    db_manager.initialize_database()
+    assert db_manager.ingest_yt_catalog(str(csv_file))["new"] == 2
+
+    # What an ingest that failed between the two inserts leaves behind.
+    with db_manager.transaction() as conn:
+        conn.execute("DELETE FROM yt_videos_embeddings WHERE id = (SELECT id FROM yt_videos WHERE url = 'https://youtu.be/b')")
+
+    report = db_manager.ingest_yt_catalog(str(csv_file))
+    assert report["missing_embedding"] == 1
+    assert report["unchanged"] == 1
+    assert report["updated"] == 0
+    with db_manager.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM yt_videos_embeddings").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM yt_videos").fetchone()[0] == 2
+    db_manager.close()
+
+
+def test_reduced_dimensions_without_sqlite_vec(tmp_path):
+    # Without sqlite-vec the full vectors are truncated in process, so startup must not need the reduced table.
+    db_manager = DatabaseManager("test", "test", backend=LocalSQLiteBackend(str(tmp_path / "test.sqlite")),
+                                 embedding_dimensions=512, embedding_quantization="int8")
+    assert db_manager.initialize_database()
+    assert not db_manager.initialize_database()
+    db_manager.close()
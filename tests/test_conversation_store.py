@@ -0,0 +1,47 @@
+import sqlite3
+
+from conversation_store import SQLiteConversationStore
+
+
+def table_totals(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(history)), 0) FROM conversations').fetchone()
+    finally:
+        conn.close()
+
+
+def test_stats_totals_follow_writes_and_pruning(tmp_path):
+    path = str(tmp_path / "conversations.sqlite")
+    store = SQLiteConversationStore(path, max_messages=2, ttl=3600)
+    store.append(1, {"role": "user", "content": "Hola"})
+    store.append(1, {"role": "assistant", "content": "¿En qué te ayudo?"}, {"role": "user", "content": "x" * 200})
+    store.append(2, {"role": "user", "content": "2 + 2"})
+    store.reset(2)
+    stats = store.stats()
+    assert (stats["entries"], stats["bytes"]) == table_totals(path)
+    assert stats["entries"] == 2
+
+    conn = sqlite3.connect(path)
+    conn.execute('UPDATE conversations SET updated_at = 0 WHERE user_id = 1')
+    conn.commit()
+    conn.close()
+    store._writes = 999
+    store.append(3, {"role": "user", "content": "Derivadas"})
+    stats = store.stats()
+    assert stats["expired"] == 1
+    assert (stats["entries"], stats["bytes"]) == table_totals(path)
+    assert store.get(1) is None
+
+
+def test_totals_of_an_existing_store(tmp_path):
+    path = str(tmp_path / "conversations.sqlite")
+    SQLiteConversationStore(path).append(1, {"role": "user", "content": "Hola"})
+    conn = sqlite3.connect(path)
+    conn.execute('DROP TABLE conversations_totals')
+    conn.commit()
+    conn.close()
+    # Reopening sums the existing rows once; a second process does not add them again.
+    SQLiteConversationStore(path)
+    store = SQLiteConversationStore(path)
+    assert (store.stats()["entries"], store.stats()["bytes"]) == table_totals(path)
@@ -0,0 +1,152 @@
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from openai_client import ResilientOpenAI
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class APITimeoutError(Exception):
+    pass
+
+
+class StubClient:
+    # Each call to chat.completions.create runs the next behaviour for its model: an exception to raise,
+    # a number of seconds to sleep before answering, or None to answer at once.
+    def __init__(self, **behaviours):
+        self.behaviours = {model: iter(steps) for model, steps in behaviours.items()}
+        self.calls = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, timeout, **kwargs):
+        with self._lock:
+            number = len(self.calls)
+            self.calls.append((model, timeout))
+            step = next(self.behaviours[model], None)
+        if isinstance(step, Exception):
+            raise step
+        if step:
+            time.sleep(step)
+        return f"{model} answer {number}"
+
+
+def make_client(stub, **kwargs):
+    return ResilientOpenAI(stub, backoff_base=0.001, backoff_max=0.001, **kwargs)
+
+
+MESSAGES = [{"role": "user", "content": "2 + 2"}]
+
+
+def test_retryable_errors_are_retried_until_success():
+    stub = StubClient(**{"gpt-4o": [StatusError(429), StatusError(503), None]})
+    client = make_client(stub)
+    assert client.complete("gpt-4o", MESSAGES) == ("gpt-4o", "gpt-4o answer 2")
+    stats = client.model_stats("gpt-4o").stats()
+    assert (stats["retries"], stats["errors_429"], stats["errors_503"], stats["requests"]) == (2, 1, 1, 1)
+
+
+def test_client_errors_are_not_retried():
+    stub = StubClient(**{"gpt-4o": [StatusError(400), None]})
+    client = make_client(stub, fallbacks={"gpt-4o": "gpt-4o-mini"})
+    with pytest.raises(StatusError):
+        client.complete("gpt-4o", MESSAGES)
+    assert [model for model, _ in stub.calls] == ["gpt-4o"]
+
+
+def test_retries_share_the_call_deadline():
+    stub = StubClient()
+    stub.behaviours = {"gpt-4o": itertools.repeat(APITimeoutError("timed out"))}
+    failing_create = stub.create
+
+    def slow_create(model, messages, timeout, **kwargs):
+        time.sleep(0.06)
+        return failing_create(model, messages, timeout, **kwargs)
+
+    stub.chat.completions.create = slow_create
+    client = ResilientOpenAI(stub, timeout=0.1, max_retries=5, backoff_base=0.0)
+    started = time.monotonic()
+    # Out of time after the second attempt: its error is raised instead of a third attempt.
+    with pytest.raises(APITimeoutError):
+        client.complete("gpt-4o", MESSAGES)
+    assert time.monotonic() - started < 0.2
+    assert len(stub.calls) == 2
+    # Each attempt gets what is left of the deadline, not a fresh timeout.
+    assert stub.calls[0][1] <= 0.1 and stub.calls[1][1] < 0.05
+
+
+def test_hedged_call_gives_up_at_the_deadline():
+    stub = StubClient(**{"gpt-4o": [0.5, 0.5]})
+    client = ResilientOpenAI(stub, timeout=0.1, hedge=True, hedge_min_delay=0.02, min_samples=3)
+    for _ in range(3):
+        client.model_stats("gpt-4o").record(0.01)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        client.complete("gpt-4o", MESSAGES)
+    assert time.monotonic() - started < 0.3
+    stats = client.model_stats("gpt-4o").stats()
+    assert (stats["hedges"], stats["deadline_exceeded"]) == (1, 1)
+    client.close()
+
+
+def test_falls_back_after_retries_are_exhausted():
+    stub = StubClient(**{"gpt-4o": [StatusError(500)] * 3, "gpt-4o-mini": [None]})
+    client = make_client(stub, max_retries=2, fallbacks={"gpt-4o": "gpt-4o-mini"})
+    assert client.complete("gpt-4o", MESSAGES) == ("gpt-4o-mini", "gpt-4o-mini answer 3")
+    assert [model for model, _ in stub.calls] == ["gpt-4o"] * 3 + ["gpt-4o-mini"]
+    assert client.model_stats("gpt-4o").stats()["fallbacks_error"] == 1
+
+
+def test_latency_pressure_falls_back_and_probes():
+    stub = StubClient()
+    stub.behaviours = {"gpt-4o": itertools.repeat(None), "gpt-4o-mini": itertools.repeat(None)}
+    client = make_client(stub, fallbacks={"gpt-4o": "gpt-4o-mini"}, fallback_latency=0.5, min_samples=3, probe_every=3)
+    assert client.complete("gpt-4o", MESSAGES)[0] == "gpt-4o"  # no samples yet
+    for _ in range(3):
+        client.model_stats("gpt-4o").record(2.0)
+    answered = [client.complete("gpt-4o", MESSAGES)[0] for _ in range(6)]
+    # Every third call under pressure still goes to the slow model, so its recovery can be seen.
+    assert answered == ["gpt-4o-mini", "gpt-4o-mini", "gpt-4o", "gpt-4o-mini", "gpt-4o-mini", "gpt-4o"]
+    assert client.model_stats("gpt-4o").stats()["fallbacks_latency"] == 4
+
+
+def test_latency_pressure_ends_when_old_samples_expire():
+    stub = StubClient()
+    stub.behaviours = {"gpt-4o": itertools.repeat(None), "gpt-4o-mini": itertools.repeat(None)}
+    client = make_client(stub, fallbacks={"gpt-4o": "gpt-4o-mini"}, fallback_latency=0.5, min_samples=3,
+                         stats_window=0.05)
+    for _ in range(3):
+        client.model_stats("gpt-4o").record(2.0)
+    assert client.complete("gpt-4o", MESSAGES)[0] == "gpt-4o-mini"
+    time.sleep(0.06)
+    assert client.complete("gpt-4o", MESSAGES)[0] == "gpt-4o"
+
+
+def test_hedge_wins_over_a_slow_primary():
+    stub = StubClient(**{"gpt-4o": [0.5, None]})
+    client = make_client(stub, hedge=True, hedge_min_delay=0.02, min_samples=3)
+    for _ in range(3):
+        client.model_stats("gpt-4o").record(0.01)
+    started = time.monotonic()
+    assert client.complete("gpt-4o", MESSAGES) == ("gpt-4o", "gpt-4o answer 1")
+    assert time.monotonic() - started < 0.3
+    stats = client.model_stats("gpt-4o").stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+    client.close()
+
+
+def test_no_hedge_without_enough_samples():
+    stub = StubClient(**{"gpt-4o": [0.05]})
+    client = make_client(stub, hedge=True, hedge_min_delay=0.01, min_samples=3)
+    assert client.complete("gpt-4o", MESSAGES) == ("gpt-4o", "gpt-4o answer 0")
+    assert len(stub.calls) == 1
+    assert "hedges" not in client.model_stats("gpt-4o").stats()
+    client.close()
@@ -0,0 +1,47 @@
+import sqlite3
+
+from response_cache import SQLiteCacheBackend
+
+
+def table_totals(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache').fetchone()
+    finally:
+        conn.close()
+
+
+def test_running_totals_follow_writes_and_evictions(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    backend = SQLiteCacheBackend(path, max_bytes=100, ttl=3600)
+    backend.set("a", b"x" * 30)
+    backend.set("b", b"x" * 30)
+    backend.set("a", b"x" * 10)  # replacing an entry only counts its new size
+    assert backend.stats()["bytes"] == 42
+    backend.get("a")
+    backend.set("c", b"x" * 60)  # over budget: "b" was used least recently
+    assert backend.get("b") is None
+    assert backend.get("a") == b"x" * 10
+    stats = backend.stats()
+    assert (stats["entries"], stats["bytes"]) == table_totals(path) == (2, 72)
+    assert stats["evictions"] == 1
+
+
+def test_totals_of_an_existing_cache_file(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE response_cache (
+            key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+            expires_at REAL NOT NULL, last_access REAL NOT NULL
+        )
+    ''')
+    conn.execute("INSERT INTO response_cache VALUES ('old', x'00', 20, 1e12, 0)")
+    conn.commit()
+    conn.close()
+    backend = SQLiteCacheBackend(path, max_bytes=100, ttl=3600)
+    assert backend.stats()["bytes"] == 20
+    # A second process opening the same file does not count the rows again.
+    assert SQLiteCacheBackend(path, max_bytes=100, ttl=3600).stats()["bytes"] == 20
+    backend.set("new", b"x" * 7)
+    assert (backend.stats()["entries"], backend.stats()["bytes"]) == table_totals(path) == (2, 30)
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_global_capacity_is_respected():
+    async def run():
+        scheduler = FairScheduler(capacity=2, per_user=1)
+        await scheduler.acquire(1)
+        await scheduler.acquire(2)
+        third = asyncio.create_task(scheduler.acquire(3))
+        await settle()
+        assert not third.done()
+        assert scheduler.stats()["waiting"] == 1
+        scheduler.release(1)
+        await settle()
+        assert third.done()
+        assert scheduler.stats()["in_use"] == 2
+
+    asyncio.run(run())
+
+
+def test_one_user_cannot_take_every_slot():
+    async def run():
+        scheduler = FairScheduler(capacity=3, per_user=1)
+        await scheduler.acquire(1)
+        second = asyncio.create_task(scheduler.acquire(1))
+        await settle()
+        assert not second.done()
+        # Capacity is left over, and another user gets it straight away.
+        await asyncio.wait_for(scheduler.acquire(2), 0.1)
+        scheduler.release(1)
+        await settle()
+        assert second.done()
+        assert scheduler.stats()["in_use"] == 2
+
+    asyncio.run(run())
+
+
+def test_waiting_users_are_served_round_robin():
+    async def run():
+        scheduler = FairScheduler(capacity=1, per_user=1)
+        order = []
+
+        async def request(user_id):
+            async with scheduler.slot(user_id):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        await scheduler.acquire("holder")
+        tasks = [asyncio.create_task(request(user_id)) for user_id in ["a", "a", "a", "b", "c"]]
+        await settle()
+        scheduler.release("holder")
+        await asyncio.gather(*tasks)
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["a", "b", "c", "a", "a"]
+    assert (stats["in_use"], stats["waiting"], stats["granted"], stats["queued"]) == (0, 0, 6, 5)
+
+
+def test_cancelled_waiter_is_forgotten():
+    async def run():
+        scheduler = FairScheduler(capacity=1, per_user=1)
+        await scheduler.acquire(1)
+        cancelled = asyncio.create_task(scheduler.acquire(2))
+        waiting = asyncio.create_task(scheduler.acquire(3))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        assert scheduler.stats()["waiting_users"] == 1
+        scheduler.release(1)
+        await settle()
+        assert waiting.done() and not waiting.cancelled()
+        assert scheduler._active == {3: 1}
+
+    asyncio.run(run())
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_released():
+    async def run():
+        scheduler = FairScheduler(capacity=1, per_user=1)
+        await scheduler.acquire(1)
+        cancelled = asyncio.create_task(scheduler.acquire(2))
+        waiting = asyncio.create_task(scheduler.acquire(3))
+        await settle()
+        # The slot is handed over, but the waiter is cancelled before it gets to run.
+        scheduler.release(1)
+        cancelled.cancel()
+        await settle()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert waiting.done()
+        assert scheduler._active == {3: 1}
+        assert scheduler.stats()["in_use"] == 1
+
+    asyncio.run(run())
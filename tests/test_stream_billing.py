@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+from math_assistant import MathAssistant
+from openai_client import PricingTable
+
+
+class Ledger:
+    def __init__(self):
+        self.rows = []
+
+    def log_openai_usage(self, user_id, model, tokens_used, estimated_cost):
+        self.rows.append((user_id, model, tokens_used, estimated_cost))
+
+
+def chunk(text=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def make_assistant(chunks):
+    def stream(model, messages, **kwargs):
+        def generate():
+            for item in chunks:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        return model, generate()
+
+    client = SimpleNamespace(stream=stream, pricing=PricingTable())
+    ledger = Ledger()
+    return MathAssistant(ledger, client), ledger
+
+
+def consume(generator):
+    parts = []
+    while True:
+        try:
+            parts.append(next(generator))
+        except StopIteration as stop:
+            return parts, stop.value
+
+
+MESSAGES = [{"role": "user", "content": "x" * 400}]
+
+
+def test_stream_with_usage_chunk_is_billed_exactly():
+    usage = SimpleNamespace(prompt_tokens=120, completion_tokens=30, total_tokens=150)
+    assistant, ledger = make_assistant([chunk("Hola"), chunk(" mundo"), chunk(usage=usage)])
+    parts, result = consume(assistant.stream_openai(MESSAGES, "gpt-4o-mini", 7))
+    assert parts == ["Hola", " mundo"]
+    assert result["total_tokens"] == 150
+    assert [row[2] for row in ledger.rows] == [150]
+
+
+def test_stream_without_usage_chunk_is_billed_an_estimate():
+    assistant, ledger = make_assistant([chunk("y" * 80)])
+    _, result = consume(assistant.stream_openai(MESSAGES, "gpt-4o-mini", 7))
+    assert result["total_tokens"] == 100 + 20
+    assert ledger.rows == [(7, "gpt-4o-mini", 120, result["cost"])]
+    assert result["cost"] > 0
+
+
+def test_stream_cut_short_bills_what_was_generated():
+    assistant, ledger = make_assistant([chunk("y" * 40), ConnectionError("reset")])
+    generator = assistant.stream_openai(MESSAGES, "gpt-4o-mini", 7)
+    assert next(generator) == "y" * 40
+    with pytest.raises(ConnectionError):
+        next(generator)
+    assert [row[2] for row in ledger.rows] == [100 + 10]
+
+
+def test_reader_that_stops_early_still_bills():
+    assistant, ledger = make_assistant([chunk("a" * 40), chunk("b" * 40)])
+    generator = assistant.stream_openai(MESSAGES, "gpt-4o-mini", 7)
+    next(generator)
+    generator.close()
+    assert [row[2] for row in ledger.rows] == [100 + 10]
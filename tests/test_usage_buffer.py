@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+from database import DatabaseManager
+from storage import LocalSQLiteBackend
+
+
+def make_db(tmp_path):
+    db_manager = DatabaseManager("test", "test", backend=LocalSQLiteBackend(str(tmp_path / "test.sqlite")))
+    db_manager.initialize_database()
+    return db_manager
+
+
+def ledger(db_manager):
+    with db_manager.get_connection() as conn:
+        usage = conn.execute('SELECT COUNT(*) FROM openai_usage').fetchone()[0]
+        balance = conn.execute('SELECT tokens_used FROM user_balances WHERE user_id = 7').fetchone()
+    return usage, balance[0] if balance else None
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_replaying_committed_rows_does_not_bill_twice(tmp_path):
+    spool = str(tmp_path / "usage_spool.jsonl")
+    db_manager = make_db(tmp_path)
+    db_manager.start_usage_writer(spool_path=spool, flush_interval=60)
+    db_manager.log_openai_usage(7, "gpt-4o", 1000, 0.01)
+    db_manager.log_openai_usage(7, "gpt-4o", 500, 0.005)
+    own_spool = db_manager.usage_buffer.spool_path
+    with open(own_spool, encoding="utf-8") as f:
+        spooled = f.read()
+    db_manager.usage_buffer.flush()
+    assert ledger(db_manager) == (2, 1500)
+
+    # A crash after the commit but before the spool was rewritten leaves the rows on disk,
+    # and the next worker finds the spool of a process that no longer exists.
+    db_manager.usage_buffer.stop()
+    db_manager.usage_buffer = None
+    orphan = str(tmp_path / f"usage_spool.{dead_pid()}.jsonl")
+    with open(orphan, "w", encoding="utf-8") as f:
+        f.write(spooled)
+    db_manager.start_usage_writer(spool_path=spool, flush_interval=60)
+    assert db_manager.usage_buffer.stats()["replayed_rows"] == 2
+    assert not os.path.exists(orphan)
+    db_manager.usage_buffer.flush()
+    assert ledger(db_manager) == (2, 1500)
+    db_manager.close()
+
+
+def test_live_workers_keep_their_spools(tmp_path):
+    spool = str(tmp_path / "usage_spool.jsonl")
+    # The pre-pid shared spool is claimed; a spool owned by a running process is left alone.
+    with open(spool, "w", encoding="utf-8") as f:
+        f.write(json.dumps([7, "2024-01-01", "gpt-4o", 300, 0.003]) + "\n")
+    live = str(tmp_path / f"usage_spool.{os.getppid()}.jsonl")
+    with open(live, "w", encoding="utf-8") as f:
+        f.write(json.dumps([7, "2024-01-01", "gpt-4o", 999, 0.01, "other-worker"]) + "\n")
+
+    db_manager = make_db(tmp_path)
+    db_manager.start_usage_writer(spool_path=spool, flush_interval=60)
+    db_manager.usage_buffer.flush()
+    assert ledger(db_manager) == (1, 300)
+    assert not os.path.exists(spool)
+    assert os.path.exists(live)
+    db_manager.close()
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from database import DatabaseManager
+from embedding_quantization import FULL_DIMENSIONS, reduce_dimensions
+from storage import LocalSQLiteBackend
+from vector_index import VideoVectorIndex
+
+
+def make_catalog(tmp_path, dimensions, count=300):
+    db_manager = DatabaseManager("test", "test", backend=LocalSQLiteBackend(str(tmp_path / "test.sqlite")),
+                                 embedding_dimensions=dimensions)
+    db_manager.initialize_database()
+    vectors = reduce_dimensions(np.random.default_rng(0).standard_normal((count, FULL_DIMENSIONS)), FULL_DIMENSIONS)
+    with db_manager.transaction() as conn:
+        for video_id, vector in enumerate(vectors, start=1):
+            conn.execute('INSERT INTO yt_videos (id, url, description) VALUES (?, ?, ?)',
+                         (video_id, f"https://youtu.be/{video_id}", f"Video {video_id}"))
+            conn.execute('INSERT INTO yt_videos_embeddings (id, embedding) VALUES (?, ?)',
+                         (video_id, db_manager._embedding_value(vector.tolist())))
+    if db_manager.backend.supports_vec and dimensions != FULL_DIMENSIONS:
+        db_manager.migrate_embeddings(dimensions, "float")
+    return db_manager, vectors
+
+
+def brute_force(vectors, query, dimensions, limit):
+    distances = np.linalg.norm(reduce_dimensions(vectors, dimensions) - reduce_dimensions(query, dimensions), axis=1)
+    top = np.argsort(distances, kind="stable")[:limit]
+    return [(int(i) + 1, float(distances[i])) for i in top]
+
+
+@pytest.mark.parametrize("dimensions", [FULL_DIMENSIONS, 256])
+def test_search_matches_exact_l2_ranking(tmp_path, dimensions):
+    db_manager, vectors = make_catalog(tmp_path, dimensions)
+    index = VideoVectorIndex(db_manager, dimensions=dimensions)
+    rng = np.random.default_rng(1)
+    # Random queries and near-duplicates of catalog vectors, whose nearest neighbour is known.
+    queries = [rng.standard_normal(FULL_DIMENSIONS) for _ in range(5)]
+    queries += [vectors[i] + 0.01 * rng.standard_normal(FULL_DIMENSIONS) for i in (0, 41, 299)]
+    for query in queries:
+        results = index.search(reduce_dimensions(query, FULL_DIMENSIONS), limit=10)
+        expected = brute_force(vectors, query, dimensions, 10)
+        assert [video_id for video_id, *_ in results] == [video_id for video_id, _ in expected]
+        np.testing.assert_allclose([distance for _, distance, *_ in results],
+                                   [distance for _, distance in expected], atol=1e-5)
+        assert results[0][2] == f"https://youtu.be/{results[0][0]}"
+        if db_manager.backend.supports_vec:
+            vec_results = db_manager.retrieve_similar_vectors(reduce_dimensions(query, FULL_DIMENSIONS).tolist(), 10)
+            assert [video_id for video_id, _ in vec_results] == [video_id for video_id, *_ in results]
+            np.testing.assert_allclose([distance for _, distance in vec_results],
+                                       [distance for _, distance, *_ in results], atol=1e-4)
+    db_manager.close()